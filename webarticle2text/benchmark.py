@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+Measures the speed and memory use of text extraction, over the compare
+fixtures and synthetic pages scaled to stress the parser.
+
+Results are written as JSON, so runs from different commits can be
+compared, e.g.
+
+    python webarticle2text/benchmark.py -o before.json
+    ...
+    python webarticle2text/benchmark.py -o after.json --compare before.json
+
+To check how extract_many() scales across cores, give the worker counts to
+compare, e.g. --workers 1,2,4,8.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import math
+import json
+import glob
+import platform
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Not available on Python 2.
+    tracemalloc = None
+
+import webarticle2text
+
+FIXTURE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'fixtures'))
+
+# The stages of an extraction, in the order they're reported.
+STAGES = ('decode', 'filter', 'tidy', 'parse', 'score', 'cleanup')
+
+PARAGRAPH = (
+    '<p>The quick brown fox jumps over the lazy dog, and then, having '
+    'thought better of it, jumps back again. Meanwhile the dog sleeps on.</p>\n'
+)
+
+def make_large_page(size):
+    """
+    Returns a page of about the given number of bytes, mostly one long article.
+    """
+    count = max(1, size // len(PARAGRAPH))
+    return ('<html><head><title>Large</title></head><body><div id="article">%s</div></body></html>' % (
+        PARAGRAPH * count)).encode('utf-8')
+
+def make_deep_page(depth):
+    """
+    Returns a page whose article is nested inside the given number of elements.
+    """
+    return ('<html><body>%s<div>%s</div>%s</body></html>' % (
+        '<div>' * depth, PARAGRAPH * 20, '</div>' * depth)).encode('utf-8')
+
+def make_many_nodes_page(count):
+    """
+    Returns a page with the given number of tiny text nodes.
+    """
+    return ('<html><body><div>%s</div></body></html>' % (
+        ''.join('<span>w%i</span> ' % i for i in range(count)))).encode('utf-8')
+
+def make_scripts_page(size):
+    """
+    Returns a page of about the given number of bytes, mostly inline scripts
+    and styles, like a page carrying its own state as JSON.
+    """
+    state = '{"items": [%s]}' % ', '.join('{"id": %i, "title": "Item %i"}' % (i, i) for i in range(100))
+    count = max(1, size // (len(state) + 200))
+    return ('<html><head><style>p { margin: 0 }</style></head><body><div id="article">%s</div>%s</body></html>' % (
+        PARAGRAPH * 20,
+        ('<script type="application/json">%s</script><!-- state -->'
+            '<style>.item { display: none }</style>' % state) * count)).encode('utf-8')
+
+def get_corpora(scale=1.0):
+    """
+    Returns an ordered dictionary of {name: [raw page bytes]}.
+    """
+    corpora = OrderedDict()
+    fixtures = sorted(glob.glob(os.path.join(FIXTURE_DIR, 'compare', 'page*.html')))
+    fixtures.append(os.path.join(FIXTURE_DIR, 'SAMPLE1.html'))
+    pages = []
+    for fn in fixtures:
+        with open(fn, 'rb') as fin:
+            pages.append(fin.read())
+    corpora['fixtures'] = pages
+    corpora['deep'] = [make_deep_page(int(1000*scale))]
+    corpora['large'] = [make_large_page(int(10*1024*1024*scale))]
+    corpora['many_nodes'] = [make_many_nodes_page(int(100000*scale))]
+    corpora['scripts'] = [make_scripts_page(int(10*1024*1024*scale))]
+    return corpora
+
+def is_tidy_available():
+    try:
+        webarticle2text.tidyHTML(b'<p>test</p>')
+        return True
+    except (ImportError, OSError):
+        return False
+
+def apply_filters(html, filters):
+    """
+    Applies a comma-delimited list of the filters named by get_filter_names().
+    """
+    for name in filters.split(','):
+        html = webarticle2text.get_filter(name.strip())(html)
+    return html
+
+def run_stages(raw, timings, blur=5, tidy=False, parser=None, memory=None, filters=None):
+    """
+    Extracts the text from a raw page the way extractFromURL() does, one
+    stage at a time, adding the seconds spent in each to timings.
+
+    If memory is given, the peak bytes allocated by each stage are recorded
+    in it instead. This requires tracemalloc, which slows everything down,
+    so timings shouldn't be taken at the same time.
+
+    If filters are given, they're applied before tidy, see apply_filters().
+    """
+    stage = [None, None]
+
+    def start(name):
+        stage[0] = name
+        if memory is not None:
+            tracemalloc.start()
+        stage[1] = time.time()
+
+    def stop():
+        timings[stage[0]] = timings.get(stage[0], 0) + time.time() - stage[1]
+        if memory is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            memory[stage[0]] = max(memory.get(stage[0], 0), peak)
+
+    start('decode')
+    encoding, _ = webarticle2text.resolve_encoding(raw)
+    stop()
+
+    html = raw
+    if filters:
+        start('filter')
+        html = apply_filters(html, filters)
+        stop()
+
+    if tidy:
+        start('tidy')
+        html = webarticle2text.tidyHTML(html)
+        stop()
+
+    start('decode')
+    html = html.decode(encoding, 'replace')
+    stop()
+
+    start('parse')
+    extractor = webarticle2text.TextExtractor()
+    extractor.pathBlur = blur
+    html_parser = webarticle2text.create_parser(extractor, parser, normalize=not tidy)
+    html_parser.feed(html)
+    html_parser.close()
+    stop()
+
+    start('score')
+    path = extractor.get_best_path()
+    stop()
+
+    start('cleanup')
+    text = u''
+    if path is not None:
+        text = webarticle2text.clean_text_list(extractor.get_text_list(path), webarticle2text.CLEANUP_STEPS)
+    stop()
+
+    return text
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values, by the nearest-rank method.
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = max(1, int(math.ceil(p / 100. * len(values))))
+    return values[rank - 1]
+
+def get_peak_rss():
+    """
+    Returns the peak resident memory of this process in bytes, or None if
+    it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def benchmark(corpora, iterations=5, blur=5, tidy=False, parser=None, filters=None):
+    """
+    Runs each corpus the given number of times, and returns a dictionary of
+    results per corpus.
+    """
+    results = OrderedDict()
+    for name, pages in corpora.items():
+        latencies = []
+        timings = {}
+        total_bytes = sum(len(raw) for raw in pages)
+        filtered_bytes = 0
+        if filters:
+            filtered_bytes = total_bytes - sum(len(apply_filters(raw, filters)) for raw in pages)
+        for _ in range(iterations):
+            for raw in pages:
+                page_timings = {}
+                run_stages(raw, page_timings, blur=blur, tidy=tidy, parser=parser, filters=filters)
+                latencies.append(sum(page_timings.values()))
+                for stage, seconds in page_timings.items():
+                    timings[stage] = timings.get(stage, 0) + seconds
+
+        memory = {}
+        if tracemalloc is not None:
+            for raw in pages:
+                run_stages(raw, {}, blur=blur, tidy=tidy, parser=parser, memory=memory, filters=filters)
+
+        seconds = sum(latencies) or 1e-9
+        documents = len(pages) * iterations
+        results[name] = OrderedDict([
+            ('documents', documents),
+            ('bytes', total_bytes * iterations),
+            ('filtered_bytes', filtered_bytes * iterations),
+            ('documents_per_sec', documents / seconds),
+            ('mb_per_sec', total_bytes * iterations / seconds / 1e6),
+            ('p50', percentile(latencies, 50)),
+            ('p95', percentile(latencies, 95)),
+            ('p99', percentile(latencies, 99)),
+            ('stages', OrderedDict(
+                (stage, OrderedDict([
+                    ('seconds', timings[stage] / documents),
+                    ('peak_bytes', memory.get(stage)),
+                ]))
+                for stage in STAGES
+                if stage in timings
+            )),
+            ('peak_rss', get_peak_rss()),
+        ])
+    return results
+
+def benchmark_workers(pages, workers, documents=500, blur=5, parser=None):
+    """
+    Extracts the given number of documents, cycling through the pages, with
+    extract_many() once for each number of workers, and returns a dictionary
+    of results per number of workers.
+
+    Each speedup is relative to one worker, and the efficiency is the
+    speedup divided by the workers, so 1.0 is perfectly linear scaling.
+    The time includes starting the worker pool.
+    """
+    htmls = [pages[i % len(pages)] for i in range(documents)]
+    results = OrderedDict()
+    baseline = None
+    for count in sorted(set([1] + list(workers))):
+        t0 = time.time()
+        for result in webarticle2text.extract_many(htmls, workers=count, blur=blur, parser=parser):
+            assert result.error is None, result.error
+        seconds = (time.time() - t0) or 1e-9
+        if baseline is None:
+            baseline = seconds
+        speedup = baseline / seconds
+        results[count] = OrderedDict([
+            ('documents', documents),
+            ('seconds', seconds),
+            ('documents_per_sec', documents / seconds),
+            ('speedup', speedup),
+            ('efficiency', speedup / count),
+        ])
+    return results
+
+def run(iterations=5, scale=1.0, blur=5, tidy=None, parser=None, filters=None, workers=None):
+    """
+    Benchmarks all corpora and returns the report as a dictionary.
+
+    If a list of worker counts is given, extract_many() is also run over
+    the fixtures with each, see benchmark_workers().
+    """
+    if tidy is None:
+        tidy = is_tidy_available()
+    corpora = get_corpora(scale)
+    report = OrderedDict([
+        ('timestamp', time.time()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('iterations', iterations),
+        ('scale', scale),
+        ('blur', blur),
+        ('tidy', tidy),
+        ('parser', webarticle2text.get_parser_name(parser)),
+        ('filters', filters),
+        ('results', benchmark(
+            corpora, iterations=iterations, blur=blur, tidy=tidy, parser=parser, filters=filters)),
+    ])
+    if workers:
+        report['workers'] = benchmark_workers(
+            corpora['fixtures'], workers, documents=int(500*scale) or 1, blur=blur, parser=parser)
+    return report
+
+def compare(old, new):
+    """
+    Returns lines describing the change in throughput and p95 latency per
+    corpus between two reports.
+    """
+    lines = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        lines.append('%s: %.2fx documents/sec, p95 %.4f -> %.4f seconds' % (
+            name,
+            result['documents_per_sec'] / (before['documents_per_sec'] or 1e-9),
+            before['p95'],
+            result['p95']))
+    return lines
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option(
+        "-n", "--iterations", dest="iterations", type='int', default=5,
+        help="The number of times each page is extracted.")
+    parser.add_option(
+        "-s", "--scale", dest="scale", type='float', default=1.0,
+        help="Scales the size of the synthetic pages, e.g. 0.1 for a quick run.")
+    parser.add_option(
+        "-b", "--blur", dest="blur", type='int', default=5,
+        help="The blur to extract with.")
+    parser.add_option(
+        "-p", "--parser", dest="parser", default=None,
+        help="The parser backend, one of [%s]." % '|'.join(webarticle2text.PARSER_BACKENDS))
+    parser.add_option(
+        "-f", "--filters", dest="filters", default=None,
+        help="A comma-delimited list of filters to apply before parsing, of [%s]." % (
+            '|'.join(webarticle2text.get_filter_names())))
+    parser.add_option(
+        "-w", "--workers", dest="workers", default=None,
+        help="A comma-delimited list of worker counts to run extract_many() with, e.g. 1,2,4,8.")
+    parser.add_option(
+        "-o", "--output", dest="output", default=None,
+        help="The file the JSON report is written to. Defaults to stdout.")
+    parser.add_option(
+        "-c", "--compare", dest="compare", default=None,
+        help="A previous JSON report to compare the results against.")
+    (options, args) = parser.parse_args()
+
+    report = run(
+        iterations=options.iterations, scale=options.scale, blur=options.blur, parser=options.parser,
+        filters=options.filters,
+        workers=[int(count) for count in options.workers.split(',')] if options.workers else None)
+    output = json.dumps(report, indent=4)
+    if options.output:
+        with open(options.output, 'w') as fout:
+            fout.write(output)
+    else:
+        print(output)
+    if options.compare:
+        with open(options.compare) as fin:
+            for line in compare(json.load(fin), report):
+                print(line, file=sys.stderr)
+    for count, result in report.get('workers', {}).items():
+        print('%i workers: %.1f documents/sec, %.2fx speedup, %.2f efficiency' % (
+            count, result['documents_per_sec'], result['speedup'], result['efficiency']), file=sys.stderr)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+Serves text extraction over HTTP from a pool of pre-warmed worker
+processes, so services can share one warm extractor and one cache instead
+of each embedding the library, e.g.
+
+    python webarticle2text/server.py --port 8080 --workers 4
+
+Endpoints:
+
+    POST /extract
+        With a body of raw HTML, returns the text extracted from it.
+        With a JSON body of {"url": ...} or {"html": ...}, returns the text
+        extracted from the page or HTML, and with a JSON list of these,
+        returns a list of results, extracted in parallel.
+    GET /extract?url=...
+        Returns the text extracted from the page.
+    GET /stats
+        Returns the queue depth, request counts and the time spent in each
+        extraction stage.
+
+Each result is a JSON object with the status, one of ok, empty or error, the
+text, the error, the seconds taken, the seconds per stage and whether the
+cache was hit. Optional blur, parser and tidy query parameters override the
+server's defaults.
+
+At most --queue documents are queued or being extracted at once. Requests
+beyond that are refused with a 503, so clients can back off instead of
+piling up.
+"""
+from __future__ import print_function
+
+import sys
+import json
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+import six
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib import parse as urlparse
+
+import webarticle2text
+
+# The per-request parameters that override the server's defaults.
+REQUEST_PARAMS = ('blur', 'parser', 'tidy')
+
+# The largest request body accepted, in bytes.
+MAX_BODY_BYTES = 10*1024*1024
+
+# The options each worker process extracts with, set by _init_worker().
+_worker_options = None
+
+def _init_worker(options):
+    global _worker_options # pylint: disable=global-statement
+    _worker_options = options
+    # Warm up, so the first requests don't pay for imports and tidy loading.
+    webarticle2text.extractFromHTML(
+        u'<html><body><p>Warming up.</p></body></html>', parser=options.get('parser'), normalize=True)
+    if options.get('tidy') != webarticle2text.TIDY_NEVER:
+        try:
+            webarticle2text.tidyHTML(b'<p>Warming up.</p>')
+        except (ImportError, OSError):
+            pass
+    webarticle2text.get_default_fetcher()
+
+def _run_task(task):
+    """
+    Extracts the text of a task, a tuple of (kind, value, params) where kind
+    is url or html, in a worker process.
+
+    Returns a tuple of the result and the ExtractStats.
+    """
+    kind, value, params = task
+    options = dict(_worker_options)
+    options.update(params)
+    stats = webarticle2text.ExtractStats()
+    t0 = time.time()
+    text, error = u'', None
+    try:
+        if kind == 'url':
+            text = webarticle2text.extractFromURL(value, stats=stats, **options)
+        else:
+            # HTML is extracted like a downloaded page, but isn't cached, since
+            # it has no url.
+            html, content_type = value
+            options['cache'] = False
+            text = webarticle2text._extract_stage( # pylint: disable=protected-access
+                None, webarticle2text.RawPage(html, {'content-type': content_type}, None),
+                stats=stats, **options)
+        text = text or u''
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    result = OrderedDict([
+        ('status', 'error' if error else ('ok' if text else 'empty')),
+        ('text', text),
+        ('error', error),
+        ('seconds', time.time() - t0),
+        ('timings', stats.timings),
+        ('cache_hit', bool(stats.counters.get('cache_text_hits') or stats.counters.get('cache_raw_hits'))),
+    ])
+    return result, stats
+
+class ServiceBusy(Exception):
+    """
+    Raised when the queue is too full to accept more documents.
+    """
+
+class ExtractionService(object):
+    """
+    Runs extractions in a pool of worker processes, with a bounded queue.
+
+    Parameters:
+    workers := int
+        The number of worker processes. Defaults to the number of CPUs.
+    max_queue := int
+        The most documents queued or being extracted at once.
+    timeout := float
+        The most seconds to wait for a document to be extracted.
+    options := dict
+        The default keyword arguments of extractFromURL(), such as cache,
+        cacheDir, blur, parser and tidy.
+    """
+
+    def __init__(self, workers=None, max_queue=64, timeout=60, **options):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.options = options
+        self.stats = webarticle2text.BatchStats()
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self.queued = 0
+        self.requests = 0
+        self.rejected = 0
+        self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(options,))
+
+    def submit(self, tasks):
+        """
+        Extracts the text of each task, a tuple of (kind, value, params),
+        in parallel, and returns the results in the same order.
+
+        Raises ServiceBusy if the queue can't take all the tasks.
+        """
+        acquired = 0
+        for _ in tasks:
+            if not self._slots.acquire(False):
+                for _ in range(acquired):
+                    self._slots.release()
+                with self._lock:
+                    self.rejected += 1
+                raise ServiceBusy('The queue is full.')
+            acquired += 1
+        with self._lock:
+            self.requests += 1
+            self.queued += acquired
+        callbacks = {'callback': self._on_done}
+        if six.PY3:
+            callbacks['error_callback'] = self._release
+        pending = [self._pool.apply_async(_run_task, (task,), **callbacks) for task in tasks]
+        results = []
+        for future in pending:
+            try:
+                result, _ = future.get(self.timeout)
+            except multiprocessing.TimeoutError:
+                result = OrderedDict([
+                    ('status', 'error'),
+                    ('text', u''),
+                    ('error', 'Timed out after %s seconds.' % self.timeout),
+                ])
+            results.append(result)
+        return results
+
+    def _on_done(self, value):
+        # Runs on the pool's result thread as each task finishes.
+        self.stats.add(value[1])
+        self._release()
+
+    def _release(self, *args):
+        # Frees the queue slot of a finished task.
+        with self._lock:
+            self.queued -= 1
+        self._slots.release()
+
+    def get_stats(self):
+        """
+        Returns a dictionary describing the load and the time spent in each
+        extraction stage.
+        """
+        with self._lock:
+            stats = OrderedDict([
+                ('uptime', time.time() - self.started),
+                ('workers', self.workers),
+                ('queued', self.queued),
+                ('max_queue', self.max_queue),
+                ('requests', self.requests),
+                ('rejected', self.rejected),
+            ])
+        stats['extract'] = self.stats.get_summary()
+        return stats
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+class BadRequest(Exception):
+    """
+    Raised when a request can't be understood.
+    """
+
+class ExtractionRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive, so clients can reuse connections.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        if path == '/stats':
+            self.send_json(200, self.server.service.get_stats())
+        elif path == '/extract':
+            try:
+                tasks = [self.get_url_task(params.pop('url', None), params)]
+            except BadRequest as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            self.extract(tasks)
+        else:
+            self.send_json(404, {'error': 'Not found.'})
+
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        if path != '/extract':
+            self.send_json(404, {'error': 'Not found.'})
+            return
+        length = int(self.headers.get('content-length') or 0)
+        if length > MAX_BODY_BYTES:
+            self.send_json(413, {'error': 'The body is larger than %i bytes.' % MAX_BODY_BYTES})
+            return
+        body = self.rfile.read(length)
+        content_type = self.headers.get('content-type') or ''
+        try:
+            if content_type.split(';')[0].strip() != 'application/json':
+                tasks = [('html', (body, content_type), self.get_params(params))]
+                self.extract(tasks)
+                return
+            data = json.loads(body.decode('utf-8'))
+            items = data if isinstance(data, list) else [data]
+            tasks = [self.get_task(item, params) for item in items]
+        except (ValueError, BadRequest) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.extract(tasks, batch=isinstance(data, list))
+
+    def get_params(self, params):
+        params = dict((name, params[name]) for name in REQUEST_PARAMS if name in params)
+        if 'blur' in params:
+            try:
+                params['blur'] = int(params['blur'])
+            except (TypeError, ValueError):
+                # raise_from() keeps this Python 2 compatible.
+                six.raise_from(BadRequest('Invalid blur.'), None)
+        if params.get('tidy', webarticle2text.TIDY_NEVER) not in webarticle2text.TIDY_CHOICES:
+            raise BadRequest('Invalid tidy mode.')
+        return params
+
+    def get_task(self, item, params):
+        if not isinstance(item, dict):
+            raise BadRequest('Each item must be an object with a url or html.')
+        item_params = dict(params)
+        item_params.update(item)
+        if 'url' in item:
+            return self.get_url_task(item['url'], item_params)
+        if 'html' in item:
+            if not isinstance(item['html'], six.text_type):
+                raise BadRequest('The html must be a string.')
+            return ('html', (item['html'].encode('utf-8'), 'text/html; charset=utf-8'), self.get_params(item_params))
+        raise BadRequest('Each item must have a url or html.')
+
+    def get_url_task(self, url, params):
+        # Only web pages are fetched, never local files.
+        if not url or urlparse.urlsplit(url).scheme not in ('http', 'https'):
+            raise BadRequest('The url must be http or https.')
+        return ('url', url, self.get_params(params))
+
+    def extract(self, tasks, batch=False):
+        try:
+            results = self.server.service.submit(tasks)
+        except ServiceBusy as e:
+            self.send_json(503, {'error': str(e)}, headers={'Retry-After': '1'})
+            return
+        self.send_json(200, results if batch else results[0])
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ExtractionServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server handing extractions to an ExtractionService.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        HTTPServer.__init__(self, address, ExtractionRequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option(
+        "--host", dest="host", default='127.0.0.1',
+        help="The address to listen on.")
+    parser.add_option(
+        "-p", "--port", dest="port", type='int', default=8080,
+        help="The port to listen on.")
+    parser.add_option(
+        "-j", "--workers", dest="workers", type='int', default=None,
+        help="The number of worker processes. Defaults to the number of CPUs.")
+    parser.add_option(
+        "-q", "--queue", dest="queue", type='int', default=64,
+        help="The most documents queued at once. Requests beyond this get a 503.")
+    parser.add_option(
+        "--timeout", dest="timeout", type='float', default=60,
+        help="The most seconds to wait for a document to be extracted.")
+    parser.add_option(
+        "-c", "--cache", dest="cache", action='store_true', default=False,
+        help="Stores and loads pages from the cache.")
+    parser.add_option(
+        "-d", "--cacheDir", dest="cacheDir", default='_cache',
+        help="The directory where cache files will be stored.")
+    parser.add_option(
+        "-b", "--blur", dest="blur", type='int', default=5,
+        help="The default blur.")
+    parser.add_option(
+        "--parser", dest="parser", default=None,
+        help="The parser backend, one of [%s]." % '|'.join(webarticle2text.PARSER_BACKENDS))
+    parser.add_option(
+        "-t", "--tidy", dest="tidy", default=webarticle2text.TIDY_ALWAYS,
+        choices=webarticle2text.TIDY_CHOICES,
+        help="When to clean up pages with tidy, one of [%s]." % '|'.join(webarticle2text.TIDY_CHOICES))
+    parser.add_option(
+        "-v", "--verbose", dest="verbose", action='store_true', default=False,
+        help="Logs each request.")
+    (options, args) = parser.parse_args()
+
+    service = ExtractionService(
+        workers=options.workers,
+        max_queue=options.queue,
+        timeout=options.timeout,
+        cache=options.cache,
+        cacheDir=options.cacheDir,
+        blur=options.blur,
+        parser=options.parser,
+        tidy=options.tidy)
+    server = ExtractionServer((options.host, options.port), service, verbose=options.verbose)
+    print('Serving on http://%s:%i/ with %i workers.' % (options.host, server.server_port, service.workers), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
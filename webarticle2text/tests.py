@@ -5,9 +5,20 @@ import sys
 import unittest
 import codecs
 import gc
+import json
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 from collections import defaultdict
 
+import six
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
 from fuzzywuzzy import fuzz
 from Levenshtein import distance
 
@@ -23,8 +34,20 @@ from newspaper import fulltext
 
 import webarticle2text
 
+import benchmark
+import server
+
 FIXTURE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'fixtures'))
 
+PACKAGE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# The most time in seconds importing the module should take.
+IMPORT_TIME_BUDGET = 0.5
+
+# The number of documents extracted by the pool soak test. Raise this, e.g. to
+# a million, to soak a change for longer.
+SOAK_DOCUMENTS = 5000
+
 # https://github.com/buriy/python-readability
 # https://pypi.python.org/pypi/readability-lxml
 def get_readability_text(html):
@@ -54,6 +77,40 @@ def get_html2text_text(html):
 def get_newspaper_text(html):
     return fulltext(html)
 
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the fixture files, standing in for a remote web server.
+    """
+
+    # Support keep-alive connections.
+    protocol_version = 'HTTP/1.1'
+
+    def translate_path(self, path):
+        return os.path.join(FIXTURE_DIR, path.lstrip('/').split('?')[0])
+
+    def do_GET(self):
+        self.server.requested.append(self.path)
+        SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_response(self, code, message=None):
+        self.server.statuses.append(code)
+        SimpleHTTPRequestHandler.send_response(self, code, message)
+
+    def log_message(self, *args):
+        pass
+
+def start_fixture_server():
+    server = FixtureServer(('127.0.0.1', 0), FixtureRequestHandler)
+    server.requested = []
+    server.statuses = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%i/' % server.server_address[1]
+
 def mean(seq):
     return sum(seq)/float(len(seq))
 
@@ -67,6 +124,938 @@ class Tests(unittest.TestCase):
         self.assertTrue(ret.startswith('Python 3.6.0 is now available!'))
         self.assertTrue(ret.endswith('is now available for download on python.org.'))
 
+    def test_plaintext_counters(self):
+        # The incrementally scored winner should match re-cleaning every path.
+        for i in range(1, 6):
+            raw_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i)
+            raw_text = codecs.open(raw_fn, "r", "utf-8", errors='ignore').read()
+            p = webarticle2text.TextExtractor()
+            p.feed(raw_text)
+            p.close()
+            expected = max(
+                (len(text), path, text)
+                for path, text in (
+                    (path, webarticle2text.clean_text_list(textList))
+                    for path, textList in p.depthText.items()
+                )
+            )[2]
+            self.assertEqual(p.get_plaintext(), expected)
+
+    def test_extract_many(self):
+        htmls = []
+        for i in range(1, 6):
+            raw_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i)
+            htmls.append(codecs.open(raw_fn, "r", "utf-8", errors='ignore').read())
+        expected = [webarticle2text.extractFromHTML(html) for html in htmls]
+        # A document that can't be extracted shouldn't abort the batch.
+        htmls.insert(2, 123)
+        expected.insert(2, None)
+        for workers in (1, 2):
+            results = list(webarticle2text.extract_many(htmls, workers=workers, chunksize=2))
+            self.assertEqual([r.index for r in results], list(range(len(htmls))))
+            self.assertEqual([r.text for r in results], expected)
+            self.assertTrue(results[2].error)
+            self.assertEqual([r.error for r in results if r.index != 2], [None]*5)
+        results = webarticle2text.extract_many(htmls, workers=2, ordered=False)
+        self.assertEqual(sorted(r.index for r in results), list(range(len(htmls))))
+
+    @unittest.skipIf(six.PY2, 'asyncio requires Python 3')
+    def test_extract_from_urls(self):
+        import asyncio
+        server, base_url = start_fixture_server()
+        try:
+            urls = [base_url + 'compare/page%i.html' % i for i in range(1, 6)]
+            expected = [webarticle2text.extractFromURL(url, tidy='never') for url in urls]
+            loop = asyncio.new_event_loop()
+            try:
+                results = loop.run_until_complete(
+                    webarticle2text.extract_from_urls(urls, concurrency=3, per_host=2, loop=loop, tidy='never'))
+            finally:
+                loop.close()
+            self.assertEqual([r.index for r in results], list(range(len(urls))))
+            self.assertEqual([r.error for r in results], [None]*len(urls))
+            self.assertEqual([r.text for r in results], expected)
+            # Without a loop, it has to be called from a running one.
+            self.assertRaises(RuntimeError, webarticle2text.extract_from_urls, urls)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_fetcher_pool(self):
+        server, base_url = start_fixture_server()
+        fetcher = webarticle2text.Fetcher()
+        try:
+            for i in range(1, 6):
+                url = base_url + 'compare/page%i.html' % i
+                self.assertEqual(
+                    webarticle2text.extractFromURL(url, fetcher=fetcher, tidy='never'),
+                    webarticle2text.extractFromURL(url, tidy='never'))
+        finally:
+            fetcher.close()
+            server.shutdown()
+            server.server_close()
+        # The pages and the host's robots.txt should have shared one connection.
+        self.assertEqual(fetcher.get_stats(), {'pool_hits': 5, 'pool_misses': 1})
+
+    def test_robots_cache(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.1)
+            return object()
+
+        cache = webarticle2text.RobotsCache(max_size=2, ttl=60)
+        # Concurrent lookups for the same host should share one load.
+        threads = [
+            threading.Thread(target=cache.get, args=('http://a/robots.txt', load))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+
+        # The least recently used policy should be evicted.
+        cache.get('http://b/robots.txt', load)
+        cache.get('http://a/robots.txt', load)
+        cache.get('http://c/robots.txt', load)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(len(loads), 3)
+        cache.get('http://a/robots.txt', load)
+        self.assertEqual(len(loads), 3)
+        cache.get('http://b/robots.txt', load)
+        self.assertEqual(len(loads), 4)
+
+        # Expired policies should be reloaded.
+        cache.ttl = 0
+        cache.get('http://d/robots.txt', load)
+        cache.get('http://d/robots.txt', load)
+        self.assertEqual(len(loads), 6)
+
+    def test_import_time(self):
+        script = '; '.join([
+            'import sys, time',
+            't = time.time()',
+            'import webarticle2text.webarticle2text',
+            'print(time.time() - t)',
+            'print(",".join(m for m in ("requests", "fake_useragent", "chardet", "tidylib") if m in sys.modules))',
+        ])
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=PACKAGE_DIR)
+        lines = output.decode('utf-8').split('\n')
+        import_time, heavy_modules = lines[0], lines[1].strip()
+        print('Import took %.3f seconds.' % float(import_time))
+        self.assertLess(float(import_time), IMPORT_TIME_BUDGET)
+        self.assertEqual(heavy_modules, '')
+
+    def test_file_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = webarticle2text.FileCache(cache_dir, max_size=300)
+            keys = [webarticle2text.generate_key('http://example.com/%i' % i) for i in range(4)]
+
+            # Entries written by older versions directly in the cache directory should still be found.
+            with open(os.path.join(cache_dir, keys[0]), 'wb') as fout:
+                fout.write(b'a'*100)
+            self.assertEqual(cache.get(keys[0]), b'a'*100)
+            self.assertTrue(os.path.isfile(cache.get_path(keys[0])))
+            self.assertEqual(os.path.dirname(cache.get_path(keys[0])), os.path.join(cache_dir, keys[0][:2], keys[0][2:4]))
+
+            cache.set(keys[1], b'b'*100)
+            cache.set(keys[2], u'c'*100)
+            # Make the first entry the least recently used.
+            for i, key in enumerate(keys[:3]):
+                atime = time.time() - 100 + i
+                os.utime(cache.get_path(key), (atime, atime))
+            self.assertEqual(cache.get(keys[3], 'missing'), 'missing')
+            self.assertEqual(cache.get_size(), 300)
+
+            # Exceeding max_size should evict the least recently used entry.
+            cache.set(keys[3], b'd'*50)
+            self.assertEqual(cache.get(keys[0]), None)
+            self.assertEqual(cache.get(keys[1]), b'b'*100)
+            self.assertEqual(cache.get_size(), 250)
+            self.assertEqual(cache.get_stats(), {'hits': 2, 'misses': 2, 'evictions': 1})
+
+            # Entries older than max_age should be evicted.
+            cache.max_age = 50
+            cache.evict()
+            self.assertEqual(cache.get(keys[2]), None)
+            self.assertEqual(cache.get(keys[3]), b'd'*50)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_extract_from_file(self):
+        for i in range(1, 6):
+            raw_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i)
+            with open(raw_fn, 'rb') as fin:
+                raw = fin.read()
+            with open(raw_fn, 'rb') as fin:
+                self.assertEqual(
+                    webarticle2text.extractFromFile(fin, chunk_size=1000),
+                    webarticle2text.extractFromHTML(raw))
+            # Reading should stop at the byte limit.
+            with open(raw_fn, 'rb') as fin:
+                self.assertEqual(
+                    webarticle2text.extractFromFile(fin, chunk_size=1000, max_bytes=20500),
+                    webarticle2text.extractFromHTML(raw[:20500]))
+                self.assertEqual(fin.tell(), 21000)
+
+        # A page of exactly max_bytes isn't truncated, and text chunks are measured in bytes too.
+        html = u'<html><body>%s<p>caf\xe9 %s</p>%s</body></html>' % ('<div>' * 5, 'word ' * 20, '</div>' * 5)
+        size = len(html.encode('utf-8'))
+        for chunks in ([html.encode('utf-8')], [html[:20], html[20:]]):
+            extractor = webarticle2text.TextExtractor()
+            text = webarticle2text.extractFromChunks(chunks, max_bytes=size, extractor=extractor)
+            self.assertEqual(text, webarticle2text.extractFromHTML(html))
+            self.assertEqual(extractor.truncated, None)
+            extractor = webarticle2text.TextExtractor()
+            text = webarticle2text.extractFromChunks(chunks, max_bytes=size - 21, extractor=extractor)
+            self.assertEqual(extractor.truncated, 'bytes')
+            self.assertEqual(text, webarticle2text.extractFromHTML(html.encode('utf-8')[:size - 21]))
+
+    def test_extract_from_url_stream(self):
+        server, base_url = start_fixture_server()
+        try:
+            for i in range(1, 6):
+                url = base_url + 'compare/page%i.html' % i
+                with open(os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i), 'rb') as fin:
+                    expected = webarticle2text.extractFromHTML(fin.read(), normalize=True)
+                actual = webarticle2text.extractFromURL(url, stream=True, encoding='utf-8')
+                self.assertEqual(actual.decode('utf-8'), expected)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @unittest.skipUnless(webarticle2text.is_parser_available('lxml'), 'lxml is not installed')
+    def test_parser_backends(self):
+        timings = defaultdict(float)
+        for i in range(1, 6):
+            raw_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i)
+            html = codecs.open(raw_fn, "r", "utf-8", errors='ignore').read()
+            # The backends agree on the raw pages, since the normalizer corrects them the way lxml does.
+            results = {}
+            for parser in webarticle2text.PARSER_BACKENDS:
+                t0 = time.time()
+                for _ in range(5):
+                    results[parser] = webarticle2text.extractFromHTML(html, parser=parser, normalize=True)
+                timings[parser] += time.time() - t0
+            self.assertTrue(results['lxml'])
+            self.assertEqual(results['lxml'], results['html.parser'])
+        for parser, seconds in timings.items():
+            print('%s: %.1f documents/sec' % (parser, 25/seconds))
+
+    def test_normalize(self):
+        # Unclosed paragraphs and list items, void and stray end tags and a missing body should be
+        # corrected to the same structure as the well-formed markup.
+        malformed = '<title>T</title><p>one<p>two</b><ul><li>a<br>b<li>c</ul><p>three'
+        wellformed = '<html><head><title>T</title></head><body><p>one</p><p>two</p>' \
+            '<ul><li>a<br/>b</li><li>c</li></ul><p>three</p></body></html>'
+        expected = webarticle2text.TextExtractor()
+        expected.feed(wellformed)
+        expected.close()
+        actual = webarticle2text.TextExtractor()
+        balancer = webarticle2text.TagBalancer(actual)
+        balancer.feed(malformed)
+        balancer.close()
+        self.assertEqual(actual.depthText, expected.depthText)
+
+        # Where they differ from browsers, libxml2's corrections are followed, like the lxml backend.
+        for html, corrected in (
+            ('<html><body><div><i><p>a</p></i></div></body></html>',
+                '<html><body><div><i></i><p>a</p></div></body></html>'),
+            ('<html><body><div><a href="/"><div>a</a></div>b</div></body></html>',
+                '<html><body><div><a href="/"><div>a</div>b</a></div></body></html>'),
+            ('<html><head><div>a</div></head><body class="b"><p>b</p></body></html>',
+                '<html><head></head><body><div>a</div><p>b</p></body></html>'),
+        ):
+            expected = webarticle2text.TextExtractor()
+            expected.feed(corrected)
+            expected.close()
+            actual = webarticle2text.TextExtractor()
+            balancer = webarticle2text.TagBalancer(actual)
+            balancer.feed(html)
+            balancer.close()
+            self.assertEqual(actual.depthText, expected.depthText)
+
+        self.assertFalse(webarticle2text.is_malformed_html(malformed))
+        self.assertTrue(webarticle2text.is_malformed_html('<div><span>a<div><em>b</div><table>c'))
+
+    def test_path_ids(self):
+        html = '<html><body><div><p>one <b>two</b></p><p>three</p></div><div>four</div></body></html>'
+        for blur in (0, 1, 2, 5):
+            p = webarticle2text.TextExtractor()
+            p.pathBlur = blur
+            p.feed(html)
+            p.close()
+            # Paths are scored by small int ids, which map back to the paths they stand for.
+            self.assertTrue(all(isinstance(path_id, int) for path_id in p.pathText))
+            paths = [p.get_path(path_id) for path_id in p.pathText]
+            self.assertEqual(len(set(paths)), len(paths))
+            for path in p.depthText:
+                self.assertTrue(isinstance(path, tuple))
+            # Ties still go to the greatest path.
+            best = p.get_best_path()
+            best_length = p.pathText[best].get_length()
+            tied = [p.get_path(path_id) for path_id, pathText in p.pathText.items() if pathText.get_length() == best_length]
+            self.assertEqual(p.get_path(best), max(tied))
+
+    def test_extract_blurs(self):
+        for i in range(1, 6):
+            raw_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i)
+            html = codecs.open(raw_fn, "r", "utf-8", errors='ignore').read()
+            t0 = time.time()
+            expected = dict((blur, webarticle2text.extractFromHTML(html, blur=blur)) for blur in (3, 5, 7))
+            separate = time.time() - t0
+            stats = webarticle2text.ExtractStats()
+            t0 = time.time()
+            actual = webarticle2text.extract_blurs(html, blurs=(3, 5, 7), stats=stats)
+            sweep = time.time() - t0
+            self.assertEqual(list(actual), [3, 5, 7])
+            self.assertEqual(dict(actual), expected)
+            self.assertEqual(list(stats.timings), ['parse', 'score', 'cleanup'])
+            print('page%i: %.4f seconds separately, %.4f in one parse' % (i, separate, sweep))
+        self.assertRaises(ValueError, webarticle2text.extract_blurs, '<p>text</p>', blurs=())
+        self.assertRaises(ValueError, webarticle2text.extract_blurs, '<p>text</p>', blurs=['x'])
+        self.assertEqual(webarticle2text.extract_blurs('<p>text</p>', blurs=['5']), {5: 'text'})
+
+    def test_text_node_stream(self):
+        for i in range(1, 6):
+            raw_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i)
+            html = codecs.open(raw_fn, "r", "utf-8", errors='ignore').read()
+            t0 = time.time()
+            stream = webarticle2text.record_text_nodes(html)
+            parse_seconds = time.time() - t0
+            data = stream.dumps()
+            expected = dict((blur, webarticle2text.extractFromHTML(html, blur=blur)) for blur in (3, 5, 7))
+            t0 = time.time()
+            stream = webarticle2text.TextNodeStream.loads(data)
+            actual = dict((blur, stream.extract(blur)) for blur in (3, 5, 7))
+            rescore_seconds = (time.time() - t0) / 3
+            # Scoring the stream again gives the same text as parsing the page again.
+            self.assertEqual(actual, expected)
+            print('page%i: %i bytes, %.4f seconds to parse, %.4f to load and score' % (
+                i, len(data), parse_seconds, rescore_seconds))
+
+        # Ignore rules can be turned off when scoring again.
+        html = '<html><body><div><p>%s</p><p>%s</p></div><div class="footer"><p>%s</p></div></body></html>' % (
+            'Article text. ' * 5, 'More article text. ' * 5, 'Footer text. ' * 50)
+        stream = webarticle2text.TextNodeStream.loads(webarticle2text.record_text_nodes(html).dumps())
+        self.assertFalse('Footer' in stream.extract())
+        self.assertFalse('Footer' in stream.extract(ignore=webarticle2text.IGNORE_RULES))
+        self.assertTrue('Footer' in stream.extract(ignore=webarticle2text.IGNORE_RULES & ~webarticle2text.IGNORE_FOOTERS))
+
+        # So can the tags whose elements are ignored.
+        html = '<html><body><p>%s</p><ul><li>%s</li></ul></body></html>' % ('Article text. ' * 5, 'List text. ' * 50)
+        stream = webarticle2text.TextNodeStream.loads(webarticle2text.record_text_nodes(html).dumps())
+        self.assertFalse('List' in stream.extract(ignored_tags=webarticle2text.IGNORED_TAGS))
+        self.assertTrue('List' in stream.extract(ignored_tags=['script', 'style']))
+        self.assertTrue('List' in stream.extract(ignore=webarticle2text.IGNORE_FOOTERS, ignored_tags=['ul']))
+        ignored_tags = webarticle2text.IGNORED_TAGS
+        try:
+            for i in range(1, 6):
+                raw_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i)
+                html = codecs.open(raw_fn, "r", "utf-8", errors='ignore').read()
+                stream = webarticle2text.record_text_nodes(html, normalize=True)
+                for tags in (ignored_tags, ('script', 'style'), ignored_tags + ('div',)):
+                    webarticle2text.IGNORED_TAGS = tags
+                    self.assertEqual(
+                        stream.extract(ignored_tags=tags), webarticle2text.extractFromHTML(html, normalize=True))
+        finally:
+            webarticle2text.IGNORED_TAGS = ignored_tags
+
+    def test_template_store(self):
+        def make_page(i, layout='<div id="nav"><ul><li>Home</li><li>News</li></ul></div>'):
+            article = ''.join(
+                '<p>Paragraph %i of article %i, with enough words to make it the longest text on the page.</p>' % (j, i)
+                for j in range(50))
+            comments = ''.join('<div class="comment"><p>Comment %i on article %i.</p></div>' % (j, i) for j in range(150))
+            return '<html><body>%s<div><div><div><div><div id="main"><h1>Title %i</h1><div>%s</div></div></div></div></div></div>' \
+                '<div><div><div><div><div>%s</div></div></div></div></div></body></html>' % (layout, i, article, comments)
+
+        store = webarticle2text.TemplateStore(min_confidence=2, verify_every=5)
+        full_seconds = templated_seconds = 0
+        for i in range(12):
+            html = make_page(i)
+            t0 = time.time()
+            expected = webarticle2text.extractFromHTML(html)
+            full_seconds += time.time() - t0
+            stats = webarticle2text.ExtractStats()
+            t0 = time.time()
+            self.assertEqual(store.extract('http://news.example.com/%i' % i, html, stats=stats), expected)
+            templated_seconds += time.time() - t0
+        # The first pages and every fifth templated page are fully scored.
+        self.assertEqual((store.hits, store.misses), (9, 3))
+        self.assertEqual(stats.counters['template_hits'], 1)
+        print('%.4f seconds fully scored, %.4f with templates' % (full_seconds, templated_seconds))
+
+        # A page with another layout falls back to full scoring.
+        html = make_page(12, layout='<div id="banner"><p>Breaking</p></div><div id="nav"></div>')
+        stats = webarticle2text.ExtractStats()
+        self.assertEqual(store.extract('http://news.example.com/12', html, stats=stats), webarticle2text.extractFromHTML(html))
+        self.assertEqual(stats.counters['template_fallbacks'], 1)
+
+        # Templates are kept per domain, blur, parser and normalize setting, and can be saved.
+        html = make_page(13, layout='<div id="banner"><p>Breaking</p></div><div id="nav"></div>')
+        store.extract('http://news.example.com/13', html)
+        self.assertEqual(store.get_template('other.example.com', 5), None)
+        self.assertNotEqual(store.get_template('news.example.com', 5), None)
+        self.assertEqual(store.get_template('news.example.com', 5, normalize=True), None)
+        other = [name for name in webarticle2text.PARSER_BACKENDS if name != webarticle2text.get_parser_name()]
+        self.assertEqual(store.get_template('news.example.com', 5, parser=other[0]), None)
+        saved = six.StringIO()
+        store.save(saved)
+        saved.seek(0)
+        loaded = webarticle2text.TemplateStore(min_confidence=2, verify_every=5)
+        loaded.load(saved)
+        self.assertEqual(loaded.get_template('news.example.com', 5), store.get_template('news.example.com', 5))
+        self.assertEqual(loaded.get_template('news.example.com', 5, normalize=True), None)
+
+    def test_extractor_pool(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            raise unittest.SkipTest('tracemalloc is not available')
+        article = '<html><body><div><p>%s</p><p>%s</p></div><div class="footer">footer</div></body></html>' % (
+            'Some article text. ' * 20, 'More article text. ' * 20)
+        # Unclosed tags, which used to grow the path without bound.
+        unbalanced = '<div><span>text ' * 150
+
+        # The class-level path is gone, and deep nesting is capped.
+        self.assertFalse(hasattr(webarticle2text.TextExtractor, 'path'))
+        p = webarticle2text.TextExtractor()
+        p.set_limits(webarticle2text.ExtractLimits(max_depth=256))
+        p.feed(unbalanced)
+        self.assertEqual(len(p.path), p.maxDepth + 1)
+        self.assertTrue(len(p.pathText) <= 2 * (p.maxDepth + 2))
+
+        pool = webarticle2text.ExtractorPool(max_size=4)
+        expected = webarticle2text.extractFromHTML(article)
+        self.assertEqual(pool.extract(article), expected)
+
+        errors = []
+        def work(n):
+            try:
+                for i in range(n):
+                    text = pool.extract(unbalanced if i % 100 == 0 else article)
+                    if i % 100 and text != expected:
+                        errors.append(text)
+            except Exception as e: # pylint: disable=broad-except
+                errors.append(e)
+
+        def soak(n, threads=4):
+            workers = [threading.Thread(target=work, args=(n//threads,)) for _ in range(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+
+        tracemalloc.start()
+        try:
+            soak(SOAK_DOCUMENTS//10)
+            gc.collect()
+            warm, _ = tracemalloc.get_traced_memory()
+            t0 = time.time()
+            soak(SOAK_DOCUMENTS)
+            seconds = time.time() - t0
+            gc.collect()
+            current, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        print('%i documents in %.1f seconds, memory %i -> %i bytes' % (SOAK_DOCUMENTS, seconds, warm, current))
+        self.assertEqual(errors, [])
+        self.assertTrue(pool.created <= 4)
+        self.assertTrue(current - warm < 100*1024)
+
+    def test_cleanup_steps(self):
+
+        def legacy_cleanup(text):
+            text = text.replace('#', '').replace(u'\xa0', ' ').replace(u'\u2019', "'")
+            text = re.sub("[\n\s]+", " ", text).strip()
+            text = re.sub("\s[\(\),;\.\?\!](?=\s)", " ", text).strip()
+            text = re.sub("[\n\s]+", " ", text).strip()
+            text = re.sub("\-{2,}", "", text).strip()
+            text = re.sub("\.{2,}", "", text).strip()
+            return text
+
+        def cleanup(text):
+            for step in webarticle2text.CLEANUP_STEPS:
+                text = step(text)
+            return text
+
+        for text in [
+            u'  a , b ; ( c ) d . . e ',
+            u'a -- b... c .--. d -.- e ?',
+            u'#\xa0x\u2019s \n\t ! y',
+        ]:
+            self.assertEqual(cleanup(text), legacy_cleanup(text))
+
+        # Other steps can be given per call, without changing the defaults for other threads.
+        html = u'<html><body><p>Some text -- with dashes...</p></body></html>'
+        self.assertEqual(webarticle2text.extractFromHTML(html), u'Some text  with dashes')
+        steps = webarticle2text.PLAINTEXT_STEPS + [lambda text: text.upper()]
+        self.assertEqual(webarticle2text.extractFromHTML(html, steps=steps), u'SOME TEXT -- WITH DASHES...')
+        self.assertEqual(webarticle2text.extract_blurs(html, blurs=[5], steps=[]), {5: u'Some text -- with dashes...'})
+        pool = webarticle2text.ExtractorPool()
+        self.assertEqual(pool.extract(html, steps=steps), u'SOME TEXT -- WITH DASHES...')
+        self.assertEqual(webarticle2text.extractFromHTML(html, stats=webarticle2text.ExtractStats(), steps=steps),
+            u'SOME TEXT -- WITH DASHES...')
+
+        # Benchmark both on a large article.
+        raw_fn = os.path.join(FIXTURE_DIR, 'compare/page1.expected.txt')
+        text = codecs.open(raw_fn, "r", "utf-8", errors='ignore').read()
+        text = u' \n#-- '.join([text] * 50)
+        self.assertEqual(cleanup(text), legacy_cleanup(text))
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        for name, func in [('legacy', legacy_cleanup), ('steps', cleanup)]:
+            t0 = time.time()
+            for _ in range(10):
+                func(text)
+            seconds = time.time() - t0
+            peak = 0
+            if tracemalloc:
+                tracemalloc.start()
+                func(text)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print('%s: %.1f MB/sec, peak memory %i bytes' % (name, 10*len(text)/seconds/1e6, peak))
+
+    def test_resolve_encoding(self):
+        resolver = webarticle2text.EncodingResolver()
+        html = u'<html><head><meta charset="iso-8859-1"></head><body>caf\xe9</body></html>'
+        self.assertEqual(resolver.resolve(codecs.BOM_UTF8 + html.encode('utf-8')), ('utf-8-sig', 'bom'))
+        self.assertEqual(resolver.resolve(html.encode('utf-16')), ('utf-16', 'bom'))
+        self.assertEqual(
+            resolver.resolve(html.encode('cp1252'), {'content-type': 'text/html; charset=Windows-1252'}),
+            (codecs.lookup('cp1252').name, 'header'))
+        self.assertEqual(
+            resolver.resolve(html.encode('latin-1'), {'content-type': 'text/html; charset=bogus'}),
+            (codecs.lookup('latin-1').name, 'meta'))
+        self.assertEqual(resolver.resolve(b'<p>plain ascii</p>'), ('utf-8', 'chardet'))
+        self.assertEqual(resolver.get_stats(), {'bom': 2, 'header': 1, 'meta': 1, 'chardet': 1, 'default': 0})
+
+        # Pages are decoded from the charset they declare, instead of chardet guessing from all of it.
+        server, base_url = start_fixture_server()
+        try:
+            before = webarticle2text.default_encoding_resolver.get_stats()
+            webarticle2text.extractFromURL(base_url + 'compare/page1.html', tidy='never')
+            after = webarticle2text.default_encoding_resolver.get_stats()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(after['meta'] - before['meta'], 1)
+
+        # The byte order mark isn't left at the start of the decoded page.
+        decoded = webarticle2text._extract_stage(None, codecs.BOM_UTF8 + html.encode('utf-8'), raw=True, tidy='never')
+        self.assertEqual(decoded, html)
+
+        # The extracted text is UTF-8 whatever the page's encoding, and has no byte order mark.
+        for content, headers in (
+            (html.encode('cp1252'), {'content-type': 'text/html; charset=windows-1252'}),
+            (codecs.BOM_UTF8 + html.encode('utf-8'), {}),
+            (html.encode('utf-16'), {}),
+            (html.encode('utf-32'), {}),
+        ):
+            text = webarticle2text._extract_stage(None, webarticle2text.RawPage(content, headers, None), tidy='never')
+            self.assertEqual(text, u'caf\xe9'.encode('utf-8'))
+
+    def test_multilevel_cache(self):
+
+        def count_entries(cache_dir, suffix):
+            return sum(
+                len([fn for fn in filenames if fn.endswith(suffix)])
+                for _, _, filenames in os.walk(cache_dir))
+
+        try:
+            webarticle2text.tidyHTML(b'<p>test</p>')
+            has_tidy = True
+        except (ImportError, OSError):
+            has_tidy = False
+        cache_dir = tempfile.mkdtemp()
+        server, base_url = start_fixture_server()
+        try:
+            url = base_url + 'compare/page1.html'
+            kwargs = dict(cache=webarticle2text.FileCache(cache_dir), ignore_robotstxt=True, tidy='never')
+            text = webarticle2text.extractFromURL(url, **kwargs)
+            self.assertTrue(text)
+            self.assertEqual(len(server.requested), 1)
+            self.assertEqual(count_entries(cache_dir, '.txt'), 1)
+
+            # The same url and parameters are served from the cache.
+            self.assertEqual(webarticle2text.extractFromURL(url, **kwargs), text)
+            self.assertEqual(len(server.requested), 1)
+
+            # The same content from another url is downloaded, but not extracted again.
+            self.assertEqual(webarticle2text.extractFromURL(url + '?utm_source=test', **kwargs), text)
+            self.assertEqual(len(server.requested), 2)
+            self.assertEqual(count_entries(cache_dir, '.txt'), 1)
+
+            # Changing the blur re-extracts the cached page without downloading it.
+            self.assertNotEqual(webarticle2text.extractFromURL(url, blur=2, **kwargs), text)
+            self.assertEqual(len(server.requested), 2)
+            self.assertEqual(count_entries(cache_dir, '.txt'), 2)
+
+            # Raw html isn't confused with cached text.
+            html = webarticle2text.extractFromURL(url, raw=True, **kwargs)
+            self.assertTrue(html.lstrip().lower().startswith(u'<!doctype'))
+
+            # Tidy's output is shared between extractions of the same content.
+            if has_tidy:
+                kwargs['tidy'] = 'always'
+                webarticle2text.extractFromURL(url, **kwargs)
+                webarticle2text.extractFromURL(url, blur=3, **kwargs)
+                self.assertEqual(count_entries(cache_dir, '.tidy'), 1)
+                self.assertEqual(len(server.requested), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(cache_dir)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'the fixture server only supports If-Modified-Since on Python 3.7+')
+    def test_revalidation(self):
+        policy = webarticle2text.FreshnessPolicy(max_age=60, use_cache_control=True)
+        info = {'fetched': 1000, 'headers': {}}
+        self.assertTrue(policy.is_fresh(info, now=1059))
+        self.assertFalse(policy.is_fresh(info, now=1060))
+        info['headers']['cache-control'] = 'public, max-age=300'
+        self.assertTrue(policy.is_fresh(info, now=1200))
+        info['headers']['cache-control'] = 'no-cache'
+        self.assertFalse(policy.is_fresh(info, now=1000))
+        self.assertTrue(webarticle2text.FreshnessPolicy().is_fresh(info, now=1e10))
+
+        cache_dir = tempfile.mkdtemp()
+        server, base_url = start_fixture_server()
+        try:
+            url = base_url + 'compare/page1.html'
+            kwargs = dict(cache=webarticle2text.FileCache(cache_dir), ignore_robotstxt=True, tidy='never')
+            text = webarticle2text.extractFromURL(url, **kwargs)
+            self.assertEqual(server.statuses, [200])
+
+            # A fresh page is used without contacting the server.
+            self.assertEqual(webarticle2text.extractFromURL(url, freshness=3600, **kwargs), text)
+            self.assertEqual(server.statuses, [200])
+
+            # A stale page is revalidated, and reused since it hasn't changed.
+            self.assertEqual(webarticle2text.extractFromURL(url, freshness=0, **kwargs), text)
+            self.assertEqual(server.statuses, [200, 304])
+            self.assertEqual(webarticle2text.extractFromURL(url, freshness=0, blur=3, **kwargs),
+                webarticle2text.extractFromURL(url, blur=3, ignore_robotstxt=True, tidy='never'))
+            self.assertEqual(server.statuses, [200, 304, 304, 200])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(cache_dir)
+
+    def test_benchmark(self):
+        # The stages run separately should extract the same text as extractFromHTML().
+        corpora = benchmark.get_corpora(scale=0.01)
+        for raw in corpora['fixtures'] + corpora['deep']:
+            self.assertEqual(
+                benchmark.run_stages(raw, {}),
+                webarticle2text.extractFromHTML(raw.decode('utf-8'), normalize=True))
+        self.assertEqual(benchmark.percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(benchmark.percentile(range(1, 101), 99), 99)
+
+        report = benchmark.run(iterations=1, scale=0.01, tidy=False)
+        self.assertEqual(list(report['results']), ['fixtures', 'deep', 'large', 'many_nodes', 'scripts'])
+        for name, result in report['results'].items():
+            self.assertEqual(list(result['stages']), ['decode', 'parse', 'score', 'cleanup'])
+            self.assertTrue(result['documents_per_sec'] > 0)
+            self.assertTrue(result['p50'] <= result['p95'] <= result['p99'])
+            print('%s: %.1f documents/sec, %.2f MB/sec' % (name, result['documents_per_sec'], result['mb_per_sec']))
+        self.assertEqual(benchmark.compare(report, report)[0].split(',')[0], 'fixtures: 1.00x documents/sec')
+
+        parallel = benchmark.benchmark_workers(corpora['fixtures'], [2], documents=24)
+        self.assertEqual(list(parallel), [1, 2])
+        self.assertEqual(parallel[1]['speedup'], 1.0)
+        for count, result in parallel.items():
+            print('%i workers: %.1f documents/sec, %.2fx speedup' % (count, result['documents_per_sec'], result['speedup']))
+
+        filtered = benchmark.run(iterations=1, scale=0.01, tidy=False, filters='strip_ignored')
+        self.assertEqual(list(filtered['results']['scripts']['stages']), ['decode', 'filter', 'parse', 'score', 'cleanup'])
+        self.assertTrue(filtered['results']['scripts']['filtered_bytes'] > 0)
+        self.assertEqual(report['results']['scripts']['filtered_bytes'], 0)
+
+    def test_strip_ignored(self):
+        # Only the contents of comments, scripts, styles and other ignored elements are removed,
+        # and only where every parser agrees on where they end.
+        cases = [
+            ('<p>a<!-- b -->c</p>', '<p>a<!---->c</p>'),
+            ('<script type="text/javascript">if (a < b) { f("<p>"); }</script>', '<script type="text/javascript"></script>'),
+            (b'<STYLE>p { margin: 0 }</style >', b'<STYLE></style >'),
+            ('<nav class="menu"><ul><li><a href="/">Home</a><br></li><li>News</li></ul></nav><p>a</p>',
+                '<nav class="menu"></nav><p>a</p>'),
+            ('<noscript><img src="/pixel.gif"></noscript>', '<noscript></noscript>'),
+            ('<script>document.write("<script></script>")</script><!-- a -->', None),
+            ('<title><script>a</script></title><!-- a -->', None),
+            ('<script/>a<!-- b -->', None),
+            ('<p title="<!-- a -->">b</p>', None),
+            ('<p><!-- a -- b --></p>', None),
+            # Unbalanced contents could close elements outside, so only balanced children are emptied.
+            ('<footer><p>a</footer>', None),
+            ('<ul><li>a<li>b</ul>', None),
+            ('<li>a<li>b</li></li>', '<li>a<li></li></li>'),
+        ]
+        for html, expected in cases:
+            self.assertEqual(webarticle2text.filter_strip_ignored(html), html if expected is None else expected)
+
+        # The text is the same as long as void elements are closed while parsing.
+        timings = defaultdict(float)
+        for name in ['compare/page%i.html' % i for i in range(1, 6)] + ['SAMPLE1.html']:
+            with open(os.path.join(FIXTURE_DIR, name), 'rb') as fin:
+                raw = fin.read()
+            t0 = time.time()
+            filtered = webarticle2text.filter_strip_ignored(raw)
+            filter_seconds = time.time() - t0
+            html = raw.decode('utf-8', 'ignore')
+            self.assertEqual(webarticle2text.filter_strip_ignored(html), filtered.decode('utf-8', 'ignore'))
+            for parser in webarticle2text.PARSER_BACKENDS:
+                t0 = time.time()
+                expected = webarticle2text.extractFromHTML(raw, parser=parser, normalize=True)
+                timings[parser] += time.time() - t0
+                t0 = time.time()
+                actual = webarticle2text.extractFromHTML(filtered, parser=parser, normalize=True)
+                timings[parser + ' filtered'] += time.time() - t0 + filter_seconds
+                self.assertEqual(actual, expected)
+            print('%s: %i of %i bytes skipped' % (name, len(raw) - len(filtered), len(raw)))
+        for parser in webarticle2text.PARSER_BACKENDS:
+            print('%s: %.4f seconds to parse, %.4f filtered' % (parser, timings[parser], timings[parser + ' filtered']))
+
+    def test_stats(self):
+        cache_dir = tempfile.mkdtemp()
+        server, base_url = start_fixture_server()
+        try:
+            url = base_url + 'compare/page1.html'
+            kwargs = dict(cache=webarticle2text.FileCache(cache_dir), tidy='never')
+            finished = []
+            stats = webarticle2text.ExtractStats(callback=lambda stage, seconds: finished.append(stage))
+            text = webarticle2text.extractFromURL(url, stats=stats, **kwargs)
+            self.assertEqual(list(stats.timings), ['robots', 'fetch', 'decode', 'parse', 'score', 'cleanup'])
+            self.assertEqual(set(finished), set(stats.timings))
+            self.assertEqual(stats.counters['bytes'], os.path.getsize(os.path.join(FIXTURE_DIR, 'compare/page1.html')))
+            self.assertTrue(stats.counters['paths'] > 1)
+            self.assertTrue(stats.counters['text_nodes'] >= stats.counters['paths'] / 2)
+            self.assertEqual(stats.values['encoding_source'], 'meta')
+
+            # A batch can collect stats directly, or merge them in.
+            batch = webarticle2text.BatchStats()
+            self.assertEqual(webarticle2text.extractFromURL(url, stats=batch, **kwargs), text)
+            batch.add(stats)
+            summary = batch.get_summary()
+            self.assertEqual(summary['counters']['cache_text_hits'], 1)
+            self.assertEqual(summary['counters']['documents'], 1)
+            self.assertEqual(summary['timings']['parse']['count'], 1)
+            self.assertEqual(summary['values'], {'encoding_source': {'meta': 1}, 'encoding': {'utf-8': 2}})
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(cache_dir)
+
+    def test_limits(self):
+        with open(os.path.join(FIXTURE_DIR, 'compare/page1.html'), 'rb') as fin:
+            html = fin.read().decode('utf-8', 'ignore')
+        text = webarticle2text.extractFromHTML(html)
+
+        # Pages within the budgets are extracted as before.
+        extractor = webarticle2text.TextExtractor()
+        limits = webarticle2text.ExtractLimits(max_bytes=len(html) + 1, max_seconds=60)
+        self.assertEqual(webarticle2text.extractFromHTML(html, extractor=extractor, limits=limits), text)
+        self.assertEqual(extractor.truncated, None)
+
+        # Exceeding a budget stops early with the text found so far.
+        budgets = [
+            ('bytes', webarticle2text.ExtractLimits(max_bytes=len(html) // 2)),
+            ('text_nodes', webarticle2text.ExtractLimits(max_text_nodes=50)),
+            ('paths', webarticle2text.ExtractLimits(max_paths=5)),
+        ]
+        for name, limits in budgets:
+            extractor = webarticle2text.TextExtractor()
+            partial = webarticle2text.extractFromHTML(html, extractor=extractor, limits=limits)
+            self.assertEqual(extractor.truncated, name)
+            self.assertTrue(partial)
+            self.assertNotEqual(partial, text)
+
+        # Pathological pages finish quickly.
+        deep = '<html><body>%s<p>%s</p></body></html>' % ('<div>' * 100000, 'Some deeply nested text. ' * 20)
+        extractor = webarticle2text.TextExtractor()
+        t0 = time.time()
+        partial = webarticle2text.extractFromHTML(
+            deep, extractor=extractor, limits=webarticle2text.ExtractLimits(max_depth=64))
+        self.assertTrue(time.time() - t0 < 5)
+        self.assertEqual(extractor.truncated, 'depth')
+        self.assertTrue('deeply nested' in partial)
+
+        # The depth budget is opt-in, and ignored elements deeper than it are ignored until they're closed.
+        nested = '<div>' * 20 + '<p>%s</p>' + '</div>' * 20
+        html = '<html><body>%s%s</body></html>' % (
+            nested % ('Some article text. ' * 10), nested % ('<nav><span>Home</span>%s</nav>' % ('Menu text. ' * 50)))
+        extractor = webarticle2text.TextExtractor()
+        webarticle2text.extractFromHTML(deep.replace('<div>' * 100000, '<div>' * 300), extractor=extractor)
+        self.assertEqual(extractor.truncated, None)
+        for limits in (None, webarticle2text.ExtractLimits(max_depth=22)):
+            self.assertFalse('Menu' in webarticle2text.extractFromHTML(html, limits=limits))
+
+        huge = '<html><body>%s</body></html>' % ('<span>word</span> ' * 500000)
+        extractor = webarticle2text.TextExtractor()
+        t0 = time.time()
+        webarticle2text.extractFromHTML(huge, extractor=extractor, limits=webarticle2text.ExtractLimits(max_seconds=0.1))
+        self.assertTrue(time.time() - t0 < 5)
+        self.assertEqual(extractor.truncated, 'time')
+
+    def test_batch(self):
+        output_dir = tempfile.mkdtemp()
+        server, base_url = start_fixture_server()
+        try:
+            sources = [os.path.join(FIXTURE_DIR, 'compare/page%i.html' % i) for i in range(1, 4)]
+            sources += [base_url + 'compare/page%i.html' % i for i in range(4, 6)]
+            list_fn = os.path.join(output_dir, 'list.txt')
+            output_fn = os.path.join(output_dir, 'output.jsonl')
+            with open(list_fn, 'w') as fout:
+                fout.write('# pages\n\n' + '\n'.join(sources) + '\n')
+
+            # Pretend a previous run failed on one input, and was interrupted after another, midway through a third.
+            first = next(webarticle2text.extract_batch(sources[:1], tidy='never'))
+            self.assertEqual(first['status'], 'ok')
+            failed = dict(first, input=sources[2], status='error', text='', error='Timeout: timed out')
+            with open(output_fn, 'w') as fout:
+                fout.write(json.dumps(failed) + '\n' + json.dumps(first) + '\n{"input": "%s", "sta' % sources[1])
+            self.assertEqual(webarticle2text.read_completed_sources(output_fn), set(sources[:1]))
+
+            subprocess.check_call(
+                [sys.executable, 'webarticle2text/webarticle2text.py',
+                    '-l', list_fn, '-j', '2', '-o', output_fn, '--resume', '-t', 'never'],
+                cwd=PACKAGE_DIR)
+            results = []
+            with open(output_fn) as fin:
+                lines = fin.read().split('\n')
+            # The line cut short is left as is, and the results after it start on a new line.
+            # The failed input is extracted again.
+            self.assertTrue(lines[2].endswith('"sta'))
+            for line in lines[1:2] + lines[3:]:
+                if line:
+                    results.append(json.loads(line))
+            self.assertEqual(sorted(result['input'] for result in results), sorted(sources))
+            for result in results:
+                self.assertEqual(result['status'], 'ok')
+                self.assertTrue(result['text'])
+                self.assertTrue('parse' in result['timings'])
+                self.assertFalse(result['cache_hit'])
+
+            # Without a list, piped input isn't read as one, and resuming needs an output file.
+            script = [sys.executable, 'webarticle2text/webarticle2text.py']
+            process = subprocess.Popen(
+                script, cwd=PACKAGE_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, _ = process.communicate(sources[0].encode('utf-8'))
+            self.assertEqual(process.returncode, 0)
+            self.assertTrue(out.startswith(b'Usage:'))
+            process = subprocess.Popen(
+                script + ['-l', list_fn, '--resume'], cwd=PACKAGE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, err = process.communicate()
+            self.assertEqual(process.returncode, 2)
+            self.assertTrue(b'--resume requires --output' in err)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(output_dir)
+
+    def test_server(self):
+        fixture_server, base_url = start_fixture_server()
+        service = server.ExtractionService(workers=2, max_queue=4, tidy='never')
+        extraction_server = server.ExtractionServer(('127.0.0.1', 0), service)
+        threading.Thread(target=extraction_server.serve_forever).start()
+        url = 'http://127.0.0.1:%i' % extraction_server.server_port
+
+        def request(path, body=None, content_type='text/html'):
+            req = six.moves.urllib.request.Request(url + path, data=body, headers={'Content-Type': content_type})
+            try:
+                response = six.moves.urllib.request.urlopen(req)
+                return response.getcode(), json.loads(response.read().decode('utf-8'))
+            except six.moves.urllib.error.HTTPError as e:
+                return e.code, json.loads(e.read().decode('utf-8'))
+
+        try:
+            with open(os.path.join(FIXTURE_DIR, 'compare/page1.html'), 'rb') as fin:
+                html = fin.read()
+            expected = webarticle2text.extractFromHTML(html, normalize=True)
+
+            # Raw HTML, HTML and urls in JSON, and batches of them are accepted.
+            status, result = request('/extract', html)
+            self.assertEqual((status, result['status'], result['text']), (200, 'ok', expected))
+            status, result = request('/extract', json.dumps({'html': html.decode('utf-8')}).encode('utf-8'), 'application/json')
+            self.assertEqual(result['text'], expected)
+            status, result = request('/extract?url=' + base_url + 'compare/page2.html')
+            self.assertEqual((status, result['status']), (200, 'ok'))
+            items = [{'url': base_url + 'compare/page%i.html' % i} for i in range(2, 5)]
+            status, results = request('/extract', json.dumps(items).encode('utf-8'), 'application/json')
+            self.assertEqual([r['status'] for r in results], ['ok'] * 3)
+
+            # Bad requests are refused, and so are batches too big for the queue.
+            self.assertEqual(request('/extract?url=/etc/passwd')[0], 400)
+            self.assertEqual(request('/extract', b'{"foo": 1}', 'application/json')[0], 400)
+            for blur in (b'"x"', b'[1]', b'{}'):
+                body = b'{"html": "<p>text</p>", "blur": ' + blur + b'}'
+                self.assertEqual(request('/extract', body, 'application/json')[0], 400)
+            items = [{'html': u'<p>text</p>'}] * 5
+            status, result = request('/extract', json.dumps(items).encode('utf-8'), 'application/json')
+            self.assertEqual(status, 503)
+
+            # Load test with more concurrent clients than the queue holds.
+            statuses = []
+            def client():
+                for _ in range(5):
+                    statuses.append(request('/extract', html)[0])
+            t0 = time.time()
+            clients = [threading.Thread(target=client) for _ in range(8)]
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            seconds = time.time() - t0
+            self.assertEqual(set(statuses) - set([200, 503]), set())
+            self.assertTrue(200 in statuses)
+            print('%i requests in %.3f seconds, %.1f/sec, %i refused' % (
+                len(statuses), seconds, len(statuses) / seconds, statuses.count(503)))
+
+            status, stats = request('/stats')
+            self.assertEqual(stats['queued'], 0)
+            self.assertEqual(stats['rejected'], 1 + statuses.count(503))
+            self.assertEqual(stats['extract']['counters']['documents'], 6 + statuses.count(200))
+        finally:
+            extraction_server.shutdown()
+            extraction_server.server_close()
+            service.close()
+            fixture_server.shutdown()
+            fixture_server.server_close()
+
+    def test_tidy_modes(self):
+        try:
+            webarticle2text.tidyHTML(b'<p>test</p>')
+        except (ImportError, OSError):
+            raise unittest.SkipTest('tidylib is not installed')
+        server, base_url = start_fixture_server()
+        timings = defaultdict(float)
+        ratios = defaultdict(list)
+        try:
+            for i in range(1, 6):
+                url = base_url + 'compare/page%i.html' % i
+                expected_fn = os.path.join(FIXTURE_DIR, 'compare/page%i.expected.txt' % i)
+                expected_text = codecs.open(expected_fn, "r", "utf-8", errors='ignore').read()
+                for tidy in webarticle2text.TIDY_CHOICES:
+                    t0 = time.time()
+                    actual_text = webarticle2text.extractFromURL(url, encoding='utf-8', tidy=tidy).decode('utf-8')
+                    timings[tidy] += time.time() - t0
+                    ratios[tidy].append(fuzz.ratio(expected_text, actual_text))
+        finally:
+            server.shutdown()
+            server.server_close()
+        for tidy in webarticle2text.TIDY_CHOICES:
+            print('tidy=%s: %.3f seconds, mean simple ratio %.1f' % (tidy, timings[tidy], mean(ratios[tidy])))
+
     def test_compare(self):
         data = defaultdict(lambda: defaultdict(list)) # {method: {metric: [data]}}
         samples = 5
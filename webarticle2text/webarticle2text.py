@@ -29,17 +29,24 @@ from __future__ import print_function
 import os
 import sys
 import time
-import formatter
 #import htmlentitydefs
 #import htmllib
 #import httplib
 #import HTMLParser
-import mimetypes
 import re
 #import StringIO
 #import urllib2
 import hashlib
-import requests
+import codecs
+import tempfile
+import functools
+import itertools
+import json
+import contextlib
+import threading
+import weakref
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from array import array
 #import robotparser
 
 # http://pythonhosted.org/six/
@@ -48,19 +55,12 @@ import requests
 import six
 from six.moves import html_entities as htmlentitydefs
 from six.moves.html_parser import HTMLParser
-from six.moves import http_client as httplib
-try:
-    from six.moves import cStringIO as StringIO
-except ImportError:
-    from six import StringIO
 from six.moves.urllib import parse as urlparse
-from six.moves.urllib.error import HTTPError
-from six.moves.urllib.request import OpenerDirector, Request, urlopen
-from six.moves.urllib import robotparser
 
-from fake_useragent import UserAgent
-
-ua = UserAgent()
+# Note, the HTTP stack, the user-agent database, tidylib and chardet (or
+# cchardet) are
+# only imported when first used, so importing this module stays cheap for
+# callers that only extract from HTML they already have.
 
 u = six.u
 unicode = six.text_type # pylint: disable=redefined-builtin
@@ -104,6 +104,286 @@ IGNORED_TAGS = (
     'label', 'footer', 'nav', 'aside',
 )
 
+# The rules that cause text to be ignored, as bit flags.
+IGNORE_TAGS = 1 # elements in IGNORED_TAGS
+IGNORE_FOOTERS = 2 # elements whose id or class mentions footer
+IGNORE_COPYRIGHTS = 4 # elements whose id or class mentions copyright
+IGNORE_COPYRIGHT_TEXT = 8 # text following a 'copyright' notice in its element
+IGNORE_RULES = IGNORE_TAGS | IGNORE_FOOTERS | IGNORE_COPYRIGHTS | IGNORE_COPYRIGHT_TEXT
+
+def get_ignore_rules(tag, attrd):
+    """
+    Returns the flags of the rules by which an element's text is ignored.
+
+    Parameters:
+    tag := str
+        The lowercase tag name.
+    attrd := dict
+        The element's attributes.
+    """
+    rules = 0
+    if tag in IGNORED_TAGS:
+        rules |= IGNORE_TAGS
+    # Attributes without a value are given as None.
+    for name in ('id', 'class'):
+        value = attrd.get(name)
+        if value:
+            value = value.lower()
+            if 'footer' in value:
+                rules |= IGNORE_FOOTERS
+            if 'copyright' in value:
+                rules |= IGNORE_COPYRIGHTS
+    return rules
+
+# Matches the whitespace runs compressed in the extracted text.
+WHITESPACE_PATTERN = re.compile("[\\n\\s]+")
+
+# Length summary of an empty chunk of text, see measure_text().
+EMPTY_MEASURE = (0, False, False)
+
+def measure_text(text):
+    """
+    Summarizes how a chunk of text contributes to the length of the final
+    plaintext, once '#' markers are removed and whitespace is compressed.
+
+    Returns a tuple of (length, starts with space, ends with space), which
+    can be combined with join_measures() without re-joining the text.
+    """
+    if '#' in text:
+        text = text.replace('#', '')
+    if u('\xa0') in text:
+        text = text.replace(u('\xa0'), ' ')
+    text = WHITESPACE_PATTERN.sub(u(' '), text)
+    if not text:
+        return EMPTY_MEASURE
+    return (len(text), text[0] == ' ', text[-1] == ' ')
+
+def join_measures(a, b):
+    """
+    Returns the measure of the concatenation of two measured chunks of text.
+    """
+    if not a[0]:
+        return b
+    if not b[0]:
+        return a
+    return (a[0] + b[0] - (a[2] and b[1]), a[1], b[2])
+
+# Characters replaced in the extracted text. Chained replace() calls, each
+# skipped if the character is absent, are much faster than translate().
+CHARACTER_REPLACEMENTS = (
+    ('#', u('')),
+    (u('\xa0'), u(' ')),
+    (u('\u2019'), u("'")),
+)
+
+# Punctuation removed when it stands alone between whitespace.
+STANDALONE_PUNCTUATION = frozenset('(),;.?!')
+
+# Matches runs of dashes and periods that may contain repeated ones.
+REPEATED_PUNCTUATION_PATTERN = re.compile("[\\-\\.]{2,}")
+
+DASHES_PATTERN = re.compile("\\-{2,}")
+
+PERIODS_PATTERN = re.compile("\\.{2,}")
+
+def replace_characters(text):
+    """
+    Removes '#' markers and replaces non-breaking spaces and curly quotes.
+    """
+    for old, new in CHARACTER_REPLACEMENTS:
+        if old in text:
+            text = text.replace(old, new)
+    return text
+
+def compress_whitespace(text):
+    """
+    Replaces each run of whitespace with a single space, and strips the
+    ends.
+    """
+    return u(' ').join(text.split())
+
+def remove_standalone_punctuation(text):
+    """
+    Compresses whitespace, and removes punctuation standing alone between
+    whitespace, in a single pass.
+    """
+    words = text.split()
+    if len(words) > 2:
+        words = [words[0]] + [
+            word for word in words[1:-1]
+            if word not in STANDALONE_PUNCTUATION
+        ] + [words[-1]]
+    return u(' ').join(words)
+
+def _remove_repeated(match):
+    return PERIODS_PATTERN.sub('', DASHES_PATTERN.sub('', match.group(0)))
+
+def remove_repeated_punctuation(text):
+    """
+    Removes consecutive dashes, then consecutive periods.
+    """
+    if '--' not in text and '..' not in text:
+        return text.strip()
+    return REPEATED_PUNCTUATION_PATTERN.sub(_remove_repeated, text).strip()
+
+# The normalization steps applied by get_plaintext().
+PLAINTEXT_STEPS = [
+    replace_characters,
+    compress_whitespace,
+]
+
+# The normalization steps applied to the text returned by extractFromHTML()
+# and friends, unless they're given others.
+CLEANUP_STEPS = [
+    replace_characters,
+    remove_standalone_punctuation,
+    remove_repeated_punctuation,
+]
+
+def clean_text_list(textList, steps=None):
+    """
+    Converts the list of text segments collected for a path into plaintext,
+    stripping the header and footer segments prefixed with a '#'.
+
+    The joined text is then passed through each of the given normalization
+    steps, PLAINTEXT_STEPS by default.
+    """
+
+    # Strip off header segments, prefixed with a '#'.
+    start = True
+    text = []
+    for t in textList:
+        if len(t.strip()):
+            if t.startswith('#') and start:
+                continue
+            start = False
+        text.append(t)
+
+    # Strip off footer segments, prefixed with a '#'.
+    start = True
+    textList = reversed(text)
+    text = []
+    for t in textList:
+        if len(t.strip()):
+            if t.startswith('#') and start:
+                continue
+            start = False
+        text.append(t)
+    text = reversed(text)
+
+    text = u('').join(text)
+    for step in PLAINTEXT_STEPS if steps is None else steps:
+        text = step(text)
+    return text
+
+class PathText(object):
+    """
+    Tracks the text collected under a single path while the document is
+    parsed.
+
+    Segments are stored as references into the extractor's shared text
+    buffer, and the length the path would have after clean_text_list()
+    is maintained incrementally, so only the winning path ever needs to
+    be materialized.
+    """
+
+    __slots__ = ('refs', 'started', 'head', 'body', 'tail', 'tail_kept')
+
+    def __init__(self):
+        # Each reference is the index of the segment in the text buffer,
+        # shifted left one bit, with the low bit set if the segment is
+        # prefixed with a '#'.
+        self.refs = array('l')
+        # True once a segment that isn't header garbage has been seen.
+        self.started = False
+        # Blank segments seen before the body starts.
+        self.head = EMPTY_MEASURE
+        # Everything from the first to the last body segment.
+        self.body = EMPTY_MEASURE
+        # Everything after the last body segment, and the subset of it
+        # that would survive footer stripping.
+        self.tail = EMPTY_MEASURE
+        self.tail_kept = EMPTY_MEASURE
+
+    def add(self, ref, measure, blank, marked):
+        """
+        Records a segment, given its measure and whether it's blank or
+        prefixed with a '#'.
+        """
+        self.refs.append(ref)
+        if blank:
+            if self.started:
+                self.tail = join_measures(self.tail, measure)
+                self.tail_kept = join_measures(self.tail_kept, measure)
+            else:
+                self.head = join_measures(self.head, measure)
+        elif marked:
+            # Possibly footer garbage, so only count it once we know
+            # more body follows. Before the body starts, it's header
+            # garbage and is dropped.
+            if self.started:
+                self.tail = join_measures(self.tail, measure)
+        else:
+            if self.started:
+                self.body = join_measures(
+                    join_measures(self.body, self.tail), measure)
+            else:
+                self.body = measure
+                self.started = True
+            self.tail = self.tail_kept = EMPTY_MEASURE
+
+    def get_length(self):
+        """
+        Returns the length of the text clean_text_list() would produce.
+        """
+        length, lead, trail = join_measures(
+            join_measures(self.head, self.body), self.tail_kept)
+        return max(0, length - lead - trail)
+
+class ExtractLimits(object):
+    """
+    Budgets bounding the work done on a single page, so pathological HTML
+    degrades to a best-effort result instead of stalling the extractor.
+    When a budget is hit, the extractor's truncated attribute names it.
+
+    Parameters:
+    max_bytes := int
+        The most characters of HTML parsed. The rest is ignored.
+    max_depth := int
+        The deepest element nesting tracked. Deeper elements, usually
+        unclosed tags, are treated as siblings at this depth, e.g. 256.
+    max_text_nodes := int
+        Parsing stops after this many text nodes.
+    max_paths := int
+        The most distinct paths scored. Text under any new path after this
+        is ignored.
+    max_seconds := float
+        Parsing stops after this many seconds.
+    """
+
+    def __init__(self, max_bytes=None, max_depth=None, max_text_nodes=None, max_paths=None, max_seconds=None):
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.max_text_nodes = max_text_nodes
+        self.max_paths = max_paths
+        self.max_seconds = max_seconds
+
+DEFAULT_LIMITS = ExtractLimits()
+
+class StopParsing(Exception):
+    """
+    Raised by the extractor to stop parsing once the rest of the document
+    can't change the result.
+    """
+
+class LimitExceeded(StopParsing):
+    """
+    Raised by the extractor to stop parsing when a budget is exhausted.
+    """
+
+# How many parser events pass between checks of the time budget.
+DEADLINE_CHECK_INTERVAL = 1024
+
 class TextExtractor(HTMLParser):
     """
     Attempts to extract the main body of text from an HTML document.
@@ -116,60 +396,206 @@ class TextExtractor(HTMLParser):
     2. Sections all exist at the same relative depth.
     """
 
-    dom = []
-    path = [0]
+    # The budgets, see ExtractLimits. If maxDepth is set, start tags nested
+    # deeper are treated as siblings at that depth so the path and the
+    # number of scored paths can't grow without bound.
+    maxDepth = DEFAULT_LIMITS.max_depth
+    maxTextNodes = DEFAULT_LIMITS.max_text_nodes
+    maxPaths = DEFAULT_LIMITS.max_paths
 
     def __init__(self):
         HTMLParser.__init__(self)
+        self.pathBlur = 5
+        # If set, the blurs scored together in one parse. See extract_blurs().
+        self.pathBlurs = None
+
+    def set_limits(self, limits):
+        """
+        Applies the budgets of an ExtractLimits to the next document parsed.
+        The time budget starts now.
+        """
+        self.maxDepth = limits.max_depth
+        self.maxTextNodes = limits.max_text_nodes
+        self.maxPaths = limits.max_paths
+        self._deadline = None
+        if limits.max_seconds is not None:
+            self._deadline = time.time() + limits.max_seconds
+
+    def reset(self):
+        """
+        Clears all per-document state, so the extractor can be reused to
+        parse another document.
+        """
+        HTMLParser.reset(self)
         self._ignore = False
         self._ignorePath = None
         self._lasttag = None
         self._depth = 0
-        self.depthText = {} # path:text
+        # All state is per instance, so extractors can be reset and reused,
+        # or run concurrently in threads.
+        self.path = [0]
+        # Each prefix of the path is interned as a small int id, so the keys
+        # of blurred paths can be looked up per text node without building
+        # tuples. _pathIds[i] is the id of path[:i+1], and id 0 is the empty
+        # path.
+        self._pathIndex = {} # (parent id, sibling index):id
+        self._pathParents = [None] # id:(parent id, sibling index)
+        self._pathIds = [self._intern_path(0, 0)]
+        # The id of the only path scored, if a template is set, and of the
+        # path whose end stops parsing.
+        self._templateId = None
+        self._templateEndId = None
+        self._overflow = 0 # start tags skipped beyond maxDepth
+        self._events = 0
+        self._deadline = None
+        # The name of the first budget hit, if any.
+        self.truncated = None
+        self.texts = [] # shared buffer of text segments
+        self.pathTexts = {} # blur:{path id:PathText}
         self.counting = 0
         self.lastN = 0
-        self.pathBlur = 5
+
+    @property
+    def pathText(self):
+        """
+        Returns a dictionary of {path id: PathText} scored at pathBlur.
+        """
+        return self.get_path_texts()
+
+    def get_path_texts(self, blur=None):
+        """
+        Returns a dictionary of {path id: PathText} scored at the given blur,
+        pathBlur by default.
+        """
+        if blur is None:
+            blur = self.pathBlur
+        return self.pathTexts.setdefault(blur, {})
+
+    @property
+    def depthText(self):
+        """
+        Returns a dictionary of {path: [text]}, materialized from the shared
+        text buffer.
+        """
+        return dict(
+            (self.get_path(path_id), self.get_text_list(path_id))
+            for path_id in self.pathText
+        )
+
+    def _intern_path(self, parent_id, index):
+        """
+        Returns the id of the path formed by appending the sibling index to
+        the path with the given id.
+        """
+        key = (parent_id, index)
+        path_id = self._pathIndex.get(key)
+        if path_id is None:
+            path_id = self._pathIndex[key] = len(self._pathParents)
+            self._pathParents.append(key)
+        return path_id
+
+    def set_template(self, path):
+        """
+        Limits scoring to the given path, as returned by get_path(), so only
+        the text under it is collected and parsing stops once it's closed,
+        e.g. the path that has won on other pages with the same layout.
+        See TemplateStore.
+        """
+        # Ids are interned in the order paths are seen, so interning the
+        # template up front gives the id the path will have when parsed.
+        path_id = 0
+        for index in path:
+            path_id = self._intern_path(path_id, index)
+        self._templateId = path_id
+        # Paths outside the root element are numbered again each time stray
+        # end tags empty the path, so only paths inside it can't recur.
+        self._templateEndId = path_id if path and path[0] == 0 else None
+
+    def get_path(self, path_id):
+        """
+        Returns the path with the given id as a tuple of sibling indexes.
+        """
+        path = []
+        parents = self._pathParents
+        while path_id:
+            path_id, index = parents[path_id]
+            path.append(index)
+        path.reverse()
+        return tuple(path)
+
+    def get_path_id(self, length):
+        """
+        Returns the id of the current path's prefix of the given length.
+        """
+        if length <= 0:
+            return 0
+        return self._pathIds[length - 1]
+
+    def get_text_list(self, path, blur=None):
+        """
+        Returns the list of text segments collected under the given path id.
+        """
+        texts = self.texts
+        return [
+            ('#' + texts[ref >> 1]) if ref & 1 else texts[ref >> 1]
+            for ref in self.get_path_texts(blur)[path].refs
+        ]
 
     def handle_starttag(self, tag, attrs):
         ignore0 = self._ignore
         tag = tag.lower()
-        if tag in IGNORED_TAGS:
-            self._ignore = True
         attrd = dict(attrs)
-        self._lasttag = tag.lower()
+        self._lasttag = tag
         self._depth += 1
-        self.path += [self.lastN]
-        self.lastN = 0
+        self._events += 1
+        if self._deadline is not None and not self._events % DEADLINE_CHECK_INTERVAL:
+            self.check_deadline()
+        if self.maxDepth is not None and len(self.path) > self.maxDepth:
+            self._overflow += 1
+            self.truncated = self.truncated or 'depth'
+        else:
+            self._pathIds.append(self._intern_path(self._pathIds[-1] if self._pathIds else 0, self.lastN))
+            self.path.append(self.lastN)
+            self.lastN = 0
 
-        # Ignore footer garbage.
-        if 'id' in attrd and 'footer' in attrd['id'].lower():
-            self._ignore = True
-        elif 'id' in attrd and 'copyright' in attrd['id'].lower():
-            self._ignore = True
-        elif 'class' in attrd and 'footer' in attrd['class'].lower():
-            self.counting = max(self.counting, 1)
-            self._ignore = True
-        elif 'class' in attrd and 'copyright' in attrd['class'].lower():
+        # Ignore scripts, navigation and footer garbage.
+        rules = get_ignore_rules(tag, attrd)
+        if rules:
             self._ignore = True
+            if rules & IGNORE_FOOTERS and 'class' in attrd:
+                self.counting = max(self.counting, 1)
 
         # If we just started ignoring, then remember the initial path
         # so we can later know when to start un-ignoring again.
         if self._ignore and not ignore0:
-            self._ignorePath = tuple(self.path)
+            self._ignorePath = self.get_path_id(len(self.path))
 
     def handle_startendtag(self, tag, attrs):
         pass
 
     def handle_endtag(self, tag):
-        if self._ignore and tuple(self.path) == self._ignorePath:
+        self._depth -= 1
+        if self._overflow:
+            # The element closed was never added to the path, so it can't be
+            # the one that started ignoring.
+            self._overflow -= 1
+            self.lastN += 1
+            return
+
+        if self._ignore and self.get_path_id(len(self.path)) == self._ignorePath:
             self._ignore = False
 
-        self._depth -= 1
         if len(self.path):
+            path_id = self._pathIds.pop()
             self.lastN = self.path.pop()
         else:
+            path_id = None
             self.lastN = 0
         self.lastN += 1
+        if path_id is not None and path_id == self._templateEndId:
+            # Once the template's element is closed, no more text can fall
+            # under it.
+            raise StopParsing()
 
     def handle_data(self, data, entity=False):
         if len(data) > 0 and not self._ignore:
@@ -179,23 +605,77 @@ class TextExtractor(HTMLParser):
             _data = data.strip().lower()
             if _data.startswith('copyright') and not self._ignore:
                 self._ignore = True
-                self._ignorePath = tuple(self.path)
+                self._ignorePath = self.get_path_id(len(self.path))
                 return
 
             if data:
 
-                rpath = tuple(self.path[:-self.pathBlur])
-                self.depthText.setdefault(rpath, [])
-                self.depthText[rpath] += [data]
-
-                # Allow one more layer below, to include
-                # text inside <i></i> or <b></b> tags.
-                # Unfortuantely, this will include a lot of crap
-                # in the page's header and footer, so we'll
-                # prefix this text with '#' and strip these out later.
-                rpath2 = tuple(self.path[:-self.pathBlur-1])
-                self.depthText.setdefault(rpath2, [])
-                self.depthText[rpath2] += ['#'+data]
+                if self.maxTextNodes is not None and len(self.texts) >= self.maxTextNodes:
+                    self.truncated = self.truncated or 'text_nodes'
+                    raise LimitExceeded(self.truncated)
+                self._events += 1
+                if self._deadline is not None and not self._events % DEADLINE_CHECK_INTERVAL:
+                    self.check_deadline()
+
+                # With a template, skip text outside it without measuring it.
+                if self._templateId is not None:
+                    depth = len(self.path) - self.pathBlur
+                    if self._templateId != self.get_path_id(depth if self.pathBlur else 0) \
+                        and self._templateId != self.get_path_id(depth - 1):
+                        return
+
+                ref = len(self.texts) << 1
+                self.texts.append(data)
+                measure = measure_text(data)
+                blank = not _data
+                marked = data.startswith('#')
+
+                # The text segments are shared, so scoring several blurs
+                # only costs a few more lookups per text node.
+                for blur in self.pathBlurs or (self.pathBlur,):
+                    pathTexts = self.get_path_texts(blur)
+
+                    # The ids of path[:-blur] and path[:-blur-1].
+                    # Note a blur of 0 blurs the path away entirely.
+                    depth = len(self.path) - blur
+                    pathText = self.get_path_text(self.get_path_id(depth if blur else 0), pathTexts)
+                    if pathText is not None:
+                        pathText.add(ref, measure, blank=blank, marked=marked)
+
+                    # Allow one more layer below, to include
+                    # text inside <i></i> or <b></b> tags.
+                    # Unfortuantely, this will include a lot of crap
+                    # in the page's header and footer, so we'll
+                    # prefix this text with '#' and strip these out later.
+                    pathText = self.get_path_text(self.get_path_id(depth - 1), pathTexts)
+                    if pathText is not None:
+                        pathText.add(ref | 1, measure, blank=False, marked=True)
+
+    def get_path_text(self, path, pathTexts=None):
+        """
+        Returns the PathText for the path id in the given dictionary, that of
+        pathBlur by default, creating it if the path budget allows, or
+        otherwise returning None.
+        """
+        if pathTexts is None:
+            pathTexts = self.pathText
+        if self._templateId is not None and path != self._templateId:
+            return None
+        pathText = pathTexts.get(path)
+        if pathText is None:
+            if self.maxPaths is not None and len(pathTexts) >= self.maxPaths:
+                self.truncated = self.truncated or 'paths'
+                return None
+            pathText = pathTexts[path] = PathText()
+        return pathText
+
+    def check_deadline(self):
+        """
+        Stops parsing if the time budget has run out.
+        """
+        if time.time() > self._deadline:
+            self.truncated = self.truncated or 'time'
+            raise LimitExceeded(self.truncated)
 
     def handle_charref(self, name):
         if name.isdigit():
@@ -207,45 +687,31 @@ class TextExtractor(HTMLParser):
     def handle_entityref(self, name):
         self.handle_charref(name)
 
-    def get_plaintext(self):
-        maxLen, maxPath, maxText, maxTextList = 0, (), '', []
-        for path, textList in six.iteritems(self.depthText):
-
-            # Strip off header segments, prefixed with a '#'.
-            start = True
-            text = []
-            for t in textList:
-                if len(t.strip()):
-                    if t.startswith('#') and start:
-                        continue
-                    start = False
-                text.append(t)
-
-            # Strip off footer segments, prefixed with a '#'.
-            start = True
-            textList = reversed(text)
-            text = []
-            for t in textList:
-                if len(t.strip()):
-                    if t.startswith('#') and start:
-                        continue
-                    start = False
-                text.append(t)
-            text = reversed(text)
-
-            text = u('').join(text).replace('#', '')
-            text = text.replace(u('\xa0'), ' ')
-            text = text.replace(u('\u2019'), "'")
-            # Compress whitespace.
-            text = re.sub("[\\n\\s]+", u(' '), text).strip()
-#            print('old:',(maxLen,maxPath,maxText,maxTextList))
-#            print('new:',(len(text),path,text,textList))
-            maxLen, maxPath, maxText, maxTextList = max(
-                (maxLen, maxPath, maxText, maxTextList),
-                (len(text), path, text, textList),
-            )
-
-        return maxText
+    def get_best_path(self, blur=None):
+        """
+        Returns the id of the path whose cleaned text is the longest at the
+        given blur, pathBlur by default, breaking ties in favor of the
+        greatest path.
+        """
+        maxLen, maxPath = 0, None
+        for path_id, pathText in six.iteritems(self.get_path_texts(blur)):
+            length = pathText.get_length()
+            if length > maxLen:
+                maxLen, maxPath = length, path_id
+            elif length == maxLen and maxLen and self.get_path(path_id) > self.get_path(maxPath):
+                # Ties are rare, so only then are the paths compared.
+                maxPath = path_id
+        return maxPath
+
+    def get_plaintext(self, steps=None, blur=None):
+        """
+        Returns the text of the best path at the given blur, pathBlur by
+        default, normalized by the given steps, PLAINTEXT_STEPS by default.
+        """
+        maxPath = self.get_best_path(blur)
+        if maxPath is None:
+            return ''
+        return clean_text_list(self.get_text_list(maxPath, blur), steps)
 
     def parse_endtag(self, i):
         # This is necessary because the underlying HTMLParser is buggy and
@@ -259,6 +725,296 @@ class TextExtractor(HTMLParser):
         # ignore all errors
         pass
 
+# Set in the flags of a text node the extractor ignored while recording it.
+NODE_IGNORED = 16
+
+# The arrays of a TextNodeStream, in the order they're serialized, and
+# their typecodes.
+TEXT_NODE_ARRAYS = (
+    ('offsets', 'i'),
+    ('path_ids', 'i'),
+    ('depths', 'i'),
+    ('flags', 'B'),
+    ('parents', 'i'),
+    ('indexes', 'i'),
+    ('tags', 'i'),
+)
+
+# Lone surrogates from character references are kept when the text is
+# serialized.
+_TEXT_ERRORS = 'surrogatepass' if six.PY3 else 'strict'
+
+def _array_to_bytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+def _array_from_bytes(typecode, data):
+    a = array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    return a
+
+class TextNodeStream(object):
+    """
+    The text nodes of a parsed page, with everything needed to score them
+    again without re-parsing the HTML, e.g. at another blur or with some of
+    the ignore rules turned off.
+
+    The text of all nodes is held in one buffer, and each node's path id,
+    depth and flags in arrays, so a stream is compact and quick to load.
+    Node i spans text[offsets[i]:offsets[i+1]]. Its flags hold the
+    IGNORE_* rules in effect for it, and NODE_IGNORED if the extractor
+    ignored it. The path ids are those of the recording extractor, path id
+    i being the child with sibling index indexes[i] of path id parents[i],
+    an element named tag_names[tags[i]], so the text under any set of tags
+    can be ignored without re-parsing.
+
+    Use record_text_nodes() to create one.
+    """
+
+    # Incremented when the serialized format changes.
+    VERSION = 2
+
+    def __init__(self, text=u'', offsets=None, path_ids=None, depths=None, flags=None, parents=None, indexes=None,
+                 tags=None, tag_names=None):
+        self.text = text
+        self.offsets = array('i', [0]) if offsets is None else offsets
+        self.path_ids = array('i') if path_ids is None else path_ids
+        self.depths = array('i') if depths is None else depths
+        self.flags = array('B') if flags is None else flags
+        self.parents = array('i', [0]) if parents is None else parents
+        self.indexes = array('i', [0]) if indexes is None else indexes
+        self.tags = array('i', [0]) if tags is None else tags
+        # Tag id 0 is that of the empty path.
+        self.tag_names = [u''] if tag_names is None else tag_names
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def get_text(self, i):
+        """
+        Returns the text of the i-th node.
+        """
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+    def get_ignored_paths(self, ignored_tags):
+        """
+        Returns an array of a flag per path id, set if the path is inside an
+        element with one of the given tag names.
+        """
+        ignored_tags = frozenset(ignored_tags)
+        names = [name in ignored_tags for name in self.tag_names]
+        parents = self.parents
+        tags = self.tags
+        ignored = array('B', [0]) * len(parents)
+        # A path is always interned after its parent.
+        for path_id in range(1, len(parents)):
+            ignored[path_id] = ignored[parents[path_id]] or names[tags[path_id]]
+        return ignored
+
+    def score(self, blur=5, ignore=None, extractor=None, ignored_tags=None):
+        """
+        Scores the text nodes at the given blur, and returns the
+        TextExtractor holding the scores, as if it had parsed the page.
+
+        Parameters:
+        blur := int
+            The path blur, see TextExtractor.
+        ignore := int
+            The IGNORE_* flags of the rules by which text is ignored. By
+            default, the nodes the recording extractor ignored are, so the
+            scores are exactly those of parsing the page again.
+        extractor := TextExtractor
+            An extractor to reset and reuse.
+        ignored_tags := iterable of str
+            The lowercase tag names whose elements' text is ignored by the
+            IGNORE_TAGS rule, instead of IGNORED_TAGS when the page was
+            recorded. The rule is then worked out from the tags of each
+            node's open elements, which only matches parsing the page again
+            if its tags were balanced, i.e. it was recorded with normalize,
+            tidy or the lxml backend.
+        """
+        p = _get_extractor(extractor, blur)
+        p._pathParents = [None] + list(zip(self.parents[1:], self.indexes[1:]))
+        pathTexts = p.get_path_texts(blur)
+        parents = self.parents
+        mask = NODE_IGNORED if ignore is None else ignore
+        ignored_paths = None
+        if ignored_tags is not None:
+            # The recorded IGNORE_TAGS flags give way to the tags of the paths.
+            if mask & (NODE_IGNORED | IGNORE_TAGS):
+                ignored_paths = self.get_ignored_paths(ignored_tags)
+            if mask & NODE_IGNORED:
+                mask = IGNORE_RULES
+            mask &= ~IGNORE_TAGS
+        blurred = {} # path id:(id of path[:-blur], id of path[:-blur-1])
+        texts = p.texts
+        offsets = self.offsets
+        flags = self.flags
+        depths = self.depths
+        for i, path_id in enumerate(self.path_ids):
+            if flags[i] & mask or (ignored_paths is not None and ignored_paths[path_id]):
+                continue
+            data = self.text[offsets[i]:offsets[i + 1]]
+            keys = blurred.get(path_id)
+            if keys is None:
+                # Walk up to the blurred paths, as handle_data() finds them.
+                # Note a blur of 0 blurs the path away entirely.
+                length = depths[i]
+                first = length - blur if blur else 0
+                second = length - blur - 1
+                keys = [0, 0]
+                ancestor = path_id
+                while length > 0 and length >= second:
+                    if length == first:
+                        keys[0] = ancestor
+                    if length == second:
+                        keys[1] = ancestor
+                    ancestor = parents[ancestor]
+                    length -= 1
+                blurred[path_id] = keys
+            ref = len(texts) << 1
+            texts.append(data)
+            measure = measure_text(data)
+            pathText = p.get_path_text(keys[0], pathTexts)
+            pathText.add(ref, measure, blank=not data.strip(), marked=data.startswith('#'))
+            pathText = p.get_path_text(keys[1], pathTexts)
+            pathText.add(ref | 1, measure, blank=False, marked=True)
+        return p
+
+    def extract(self, blur=5, ignore=None, ignored_tags=None):
+        """
+        Returns the text extracted from the nodes at the given blur, the same
+        as extractFromHTML() returns for the page. See score().
+        """
+        return _get_cleaned_text(self.score(blur, ignore, ignored_tags=ignored_tags), NULL_STATS)
+
+    def dumps(self):
+        """
+        Returns the stream serialized as bytes, see loads().
+        """
+        parts = [_array_to_bytes(getattr(self, name)) for name, _ in TEXT_NODE_ARRAYS]
+        parts.append(self.text.encode('utf-8', _TEXT_ERRORS))
+        header = {
+            'version': self.VERSION,
+            'byteorder': sys.byteorder,
+            'sizes': [len(part) for part in parts],
+            'tags': self.tag_names,
+        }
+        return json.dumps(header).encode('ascii') + b'\n' + b''.join(parts)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Returns a stream loaded from bytes returned by dumps().
+        """
+        i = data.index(b'\n')
+        header = json.loads(data[:i].decode('ascii'))
+        if header['version'] != cls.VERSION:
+            raise ValueError('Unsupported text node stream version: %s' % header['version'])
+        i += 1
+        kwargs = {}
+        sizes = header['sizes']
+        for (name, typecode), size in zip(TEXT_NODE_ARRAYS, sizes):
+            a = kwargs[name] = _array_from_bytes(typecode, data[i:i + size])
+            if header['byteorder'] != sys.byteorder:
+                a.byteswap()
+            i += size
+        text = data[i:i + sizes[-1]].decode('utf-8', _TEXT_ERRORS)
+        return cls(text=text, tag_names=header['tags'], **kwargs)
+
+class TextNodeRecorder(TextExtractor):
+    """
+    A TextExtractor that also records every text node it sees, ignored or
+    not, into a TextNodeStream.
+    """
+
+    def reset(self):
+        TextExtractor.reset(self)
+        self._nodeTexts = []
+        self._nodeOffset = 0
+        self._offsets = array('i', [0])
+        self._nodePathIds = array('i')
+        self._depths = array('i')
+        self._flags = array('B')
+        # The tag id of the first element seen at each path id.
+        self._pathTags = {}
+        self._tagIds = {u'': 0}
+        self._tagNames = [u'']
+        # The path id at which each rule's ignored region started, if any.
+        self._ruleStarts = {}
+
+    def handle_starttag(self, tag, attrs):
+        depth = len(self.path)
+        TextExtractor.handle_starttag(self, tag, attrs)
+        tag = tag.lower()
+        if len(self.path) > depth:
+            tag_id = self._tagIds.get(tag)
+            if tag_id is None:
+                tag_id = self._tagIds[tag] = len(self._tagNames)
+                self._tagNames.append(tag)
+            self._pathTags.setdefault(self._pathIds[-1], tag_id)
+        rules = get_ignore_rules(tag, dict(attrs))
+        if rules:
+            self._start_rules(rules)
+
+    def handle_endtag(self, tag):
+        if self._ruleStarts and not self._overflow:
+            path_id = self.get_path_id(len(self.path))
+            for rule, start in list(self._ruleStarts.items()):
+                if start == path_id:
+                    del self._ruleStarts[rule]
+        TextExtractor.handle_endtag(self, tag)
+
+    def _start_rules(self, rules):
+        path_id = self.get_path_id(len(self.path))
+        for rule in (IGNORE_TAGS, IGNORE_FOOTERS, IGNORE_COPYRIGHTS, IGNORE_COPYRIGHT_TEXT):
+            if rules & rule and rule not in self._ruleStarts:
+                self._ruleStarts[rule] = path_id
+
+    def handle_data(self, data, entity=False):
+        if not data:
+            return
+        count = len(self.texts)
+        TextExtractor.handle_data(self, data, entity)
+        if data.strip().lower().startswith('copyright'):
+            # The notice itself is ignored along with the text after it.
+            self._start_rules(IGNORE_COPYRIGHT_TEXT)
+        flags = 0
+        for rule in self._ruleStarts:
+            flags |= rule
+        if len(self.texts) == count:
+            flags |= NODE_IGNORED
+        self._nodeTexts.append(data)
+        self._nodeOffset += len(data)
+        self._offsets.append(self._nodeOffset)
+        self._nodePathIds.append(self.get_path_id(len(self.path)))
+        self._depths.append(len(self.path))
+        self._flags.append(flags)
+
+    def get_text_nodes(self):
+        """
+        Returns the TextNodeStream of the nodes recorded so far.
+        """
+        parents = array('i', [0])
+        indexes = array('i', [0])
+        tags = array('i', [0])
+        for path_id, (parent, index) in enumerate(self._pathParents[1:], 1):
+            parents.append(parent)
+            indexes.append(index)
+            tags.append(self._pathTags.get(path_id, 0))
+        return TextNodeStream(
+            text=u''.join(self._nodeTexts),
+            offsets=array('i', self._offsets),
+            path_ids=array('i', self._nodePathIds),
+            depths=array('i', self._depths),
+            flags=array('B', self._flags),
+            parents=parents,
+            indexes=indexes,
+            tags=tags,
+            tag_names=list(self._tagNames))
+
 #class HTMLParserNoFootNote(htmllib.HTMLParser):
 class HTMLParserNoFootNote(HTMLParser):
     """
@@ -269,11 +1025,13 @@ class HTMLParserNoFootNote(HTMLParser):
 
     textPattern = None
 
-    path = [0]
+    def reset(self):
+        HTMLParser.reset(self)
+        self.path = [0]
 
     def handle_starttag(self, tag, attrs, *args):
         time.sleep(0.5)
-        self.path += [0]
+        self.path.append(0)
         if tag == 'script':
             pass
 
@@ -297,9 +1055,423 @@ class HTMLParserNoFootNote(HTMLParser):
         #htmllib.HTMLParser.handle_data(self, data)
         HTMLParser.handle_data(self, data)
 
-def extractFromHTML(html, blur=5):
+# Elements that never have content or an end tag.
+VOID_TAGS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr',
+])
+
+class _LxmlTarget(object):
+    """
+    An lxml parser target that forwards events to a TextExtractor.
+    """
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+
+    def start(self, tag, attrib):
+        # Void elements are reported like self-closing tags, which the
+        # extractor doesn't track.
+        if tag not in VOID_TAGS:
+            self.extractor.handle_starttag(tag, attrib.items())
+
+    def end(self, tag):
+        if tag not in VOID_TAGS:
+            self.extractor.handle_endtag(tag)
+
+    def data(self, data):
+        self.extractor.handle_data(data)
+
+    def close(self):
+        pass
+
+class LxmlParser(object):
+    """
+    Parses HTML with lxml's C-accelerated parser, sending the events to a
+    TextExtractor as if they came from its own HTMLParser.
+
+    On well-formed markup, such as the output of tidyHTML(), the events and
+    so the extracted text are the same as the stdlib parser's. On raw HTML
+    they can differ, since lxml balances unclosed tags and inserts implied
+    ones, whereas the stdlib parser reports the tags exactly as written.
+    """
+
+    def __init__(self, extractor):
+        from lxml import etree
+        self._parser = etree.HTMLParser(target=_LxmlTarget(extractor))
+
+    def feed(self, html):
+        self._parser.feed(html)
+
+    def close(self):
+        # lxml raises an error if it was never fed anything.
+        self._parser.feed(u(''))
+        self._parser.close()
+
+def _create_stdlib_parser(extractor):
+    return extractor
+
+# {name: function returning an object with feed() and close() methods
+#   that parses HTML into events for the given extractor}
+# in order of preference.
+PARSER_BACKENDS = OrderedDict([
+    ('lxml', LxmlParser),
+    ('html.parser', _create_stdlib_parser),
+])
+
+# The parser backend used when none is given. May be any key of
+# PARSER_BACKENDS or 'auto' to use the fastest one installed.
+DEFAULT_PARSER = 'html.parser'
+
+_available_parsers = {}
+
+def is_parser_available(name):
+    """
+    Returns true if the dependencies of the named parser backend are
+    installed.
+    """
+    if name not in _available_parsers:
+        if name == 'lxml':
+            try:
+                import lxml.etree # pylint: disable=unused-variable
+                _available_parsers[name] = True
+            except ImportError:
+                _available_parsers[name] = False
+        else:
+            _available_parsers[name] = name in PARSER_BACKENDS
+    return _available_parsers[name]
+
+def get_parser_name(parser=None):
+    """
+    Resolves a parser option to the name of a backend, choosing the first
+    one installed for 'auto'.
+    """
+    parser = parser or DEFAULT_PARSER
+    if parser == 'auto':
+        for name in PARSER_BACKENDS:
+            if is_parser_available(name):
+                return name
+    if parser not in PARSER_BACKENDS:
+        raise ValueError('Unknown parser %r. Must be one of: auto, %s' % (parser, ', '.join(PARSER_BACKENDS)))
+    return parser
+
+# Elements whose end tag may be omitted, mapped to the open elements a new
+# start tag of that type implicitly closes.
+IMPLIED_END_TAGS = {
+    'p': ('p',),
+    'li': ('li',),
+    'dt': ('dt', 'dd'),
+    'dd': ('dt', 'dd'),
+    'tr': ('tr', 'td', 'th'),
+    'td': ('td', 'th'),
+    'th': ('td', 'th'),
+    'option': ('option',),
+}
+
+# Block elements whose start tag implicitly closes an open <p>.
+P_CLOSING_TAGS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'div', 'dl', 'fieldset',
+    'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'main',
+    'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul',
+])
+
+# Elements an implied end tag never closes past.
+SCOPE_TAGS = frozenset([
+    'html', 'body', 'div', 'table', 'td', 'th', 'ul', 'ol', 'dl',
+    'blockquote', 'section', 'article', 'form',
+])
+
+# An end tag is ignored rather than close an open element with a higher
+# priority than its own, as libxml2 does, e.g. </a> doesn't close a <div>
+# opened inside the link. Other elements have a priority of 100.
+END_TAG_PRIORITIES = {
+    'div': 150,
+    'td': 160,
+    'th': 160,
+    'tr': 170,
+    'thead': 180,
+    'tbody': 180,
+    'tfoot': 180,
+    'table': 190,
+    'head': 200,
+    'body': 200,
+    'html': 220,
+}
+
+# Inline elements a new <p> closes, if they're the innermost open ones,
+# as libxml2 does.
+FONT_STYLE_TAGS = frozenset(['tt', 'i', 'b', 'u', 's', 'strike', 'big', 'small'])
+
+# Elements that belong in the <head>.
+HEAD_TAGS = frozenset(['head', 'title', 'meta', 'link', 'base', 'script', 'style'])
+
+class TagBalancer(HTMLParser):
+    """
+    Parses HTML with the stdlib parser and fixes the most common problems
+    tidy would otherwise fix before the events reach the extractor:
+    unclosed <p>, <li> and similar elements are closed, stray end tags are
+    dropped, void elements are never left open, and missing <html> and
+    <body> elements are added. Where browsers differ, it follows libxml2,
+    so it gives the same events as the lxml backend on common markup.
+    """
+
+    def __init__(self, extractor):
+        HTMLParser.__init__(self)
+        self.extractor = extractor
+        self.stack = []
+        self._body = False
+
+    def _start(self, tag, attrs=()):
+        self.stack.append(tag)
+        self.extractor.handle_starttag(tag, attrs)
+
+    def _end_to(self, index):
+        # Closes all open elements from the top of the stack down to index.
+        while len(self.stack) > index:
+            self.extractor.handle_endtag(self.stack.pop())
+
+    def _ensure_body(self, tag=None):
+        if not self.stack and tag != 'html':
+            self._start('html')
+        if not self._body and tag not in HEAD_TAGS and tag != 'html':
+            if 'head' in self.stack:
+                self._end_to(self.stack.index('head'))
+            self._body = True
+            if tag != 'body':
+                self._start('body')
+
+    def handle_starttag(self, tag, attrs):
+        tag = tag.lower()
+        if tag in VOID_TAGS:
+            return
+        if tag == 'html' and self.stack:
+            return
+        if tag == 'body' and self._body:
+            # The body was already started, e.g. by text in the head.
+            return
+        self._ensure_body(tag)
+
+        if tag == 'p':
+            while self.stack and self.stack[-1] in FONT_STYLE_TAGS:
+                self._end_to(len(self.stack) - 1)
+
+        closes = IMPLIED_END_TAGS.get(tag, ())
+        if tag in P_CLOSING_TAGS:
+            closes += ('p',)
+        if closes:
+            for index in range(len(self.stack) - 1, -1, -1):
+                if self.stack[index] in closes:
+                    self._end_to(index)
+                    break
+                if self.stack[index] in SCOPE_TAGS:
+                    break
+
+        self._start(tag, attrs)
+
+    def handle_endtag(self, tag):
+        tag = tag.lower()
+        if tag in VOID_TAGS:
+            return
+        priority = END_TAG_PRIORITIES.get(tag, 100)
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index] == tag:
+                self._end_to(index)
+                return
+            if END_TAG_PRIORITIES.get(self.stack[index], 100) > priority:
+                break
+        # Otherwise it's a stray end tag, so ignore it.
+
+    def handle_data(self, data):
+        # Text outside the head's own elements starts the body.
+        if not self._body and data.strip() and (not self.stack or self.stack[-1] not in HEAD_TAGS):
+            self._ensure_body()
+        self.extractor.handle_data(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._end_to(0)
+
+    def error(self, msg):
+        # ignore all errors
+        pass
+
+def create_parser(extractor, parser=None, normalize=False):
+    """
+    Returns an object with feed() and close() methods that parses HTML with
+    the given backend, sending the events to the extractor.
+
+    If normalize is true, the events are corrected for malformed markup,
+    as an inexpensive substitute for running the HTML through tidy.
+    """
+    name = get_parser_name(parser)
+    if normalize and name == 'html.parser':
+        return TagBalancer(extractor)
+    # lxml always balances the tags it reports.
+    return PARSER_BACKENDS[name](extractor)
+
+class ExtractStats(object):
+    """
+    Collects what happened during an extraction: the seconds spent in each
+    stage, counters like the bytes read and paths scored, and values like
+    the source of the encoding.
+
+    Pass one as the stats argument of extractFromURL() or extractFromHTML().
+
+    Stages are robots, fetch, decode, filter, tidy, parse, score and cleanup.
+    Counters are bytes, filtered_bytes, text_nodes, paths, cache_text_hits,
+    cache_raw_hits, cache_tidy_hits, not_modified, template_hits and
+    template_fallbacks.
+
+    Parameters:
+    callback := callable
+        Called with (stage, seconds) as each stage finishes.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.timings = OrderedDict()
+        self.counters = OrderedDict()
+        self.values = OrderedDict()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Context manager that adds the time spent inside it to the stage.
+        """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - t0)
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0) + seconds
+        if self.callback is not None:
+            self.callback(stage, seconds)
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def as_dict(self):
+        return {
+            'timings': dict(self.timings),
+            'counters': dict(self.counters),
+            'values': dict(self.values),
+        }
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+class _NullStats(object):
+    """
+    Stands in for a stats object when none is given, doing nothing.
+    """
+
+    _timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def incr(self, name, n=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+NULL_STATS = _NullStats()
+
+class BatchStats(object):
+    """
+    Aggregates the stats of many extractions, e.g. of a crawl.
+
+    It can be passed as the stats argument in place of an ExtractStats, and
+    shared between threads, or ExtractStats can be merged in with add().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = defaultdict(list) # {stage: [seconds]}
+        self.counters = defaultdict(int)
+        self.values = defaultdict(lambda: defaultdict(int)) # {name: {value: count}}
+
+    def timer(self, stage):
+        return ExtractStats(callback=self.add_time).timer(stage)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.timings[stage].append(seconds)
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def set(self, name, value):
+        with self._lock:
+            self.values[name][value] += 1
+
+    def add(self, stats):
+        """
+        Merges in the stats of one extraction.
+        """
+        with self._lock:
+            self.counters['documents'] += 1
+            for stage, seconds in stats.timings.items():
+                self.timings[stage].append(seconds)
+            for name, n in stats.counters.items():
+                self.counters[name] += n
+            for name, value in stats.values.items():
+                self.values[name][value] += 1
+
+    def get_summary(self):
+        """
+        Returns a dictionary with the total, mean, p50 and p95 seconds of each
+        stage, the totals of each counter, including the number of documents
+        merged in with add(), and the counts of each value.
+        """
+        with self._lock:
+            timings = {}
+            for stage, seconds in self.timings.items():
+                seconds = sorted(seconds)
+                timings[stage] = {
+                    'count': len(seconds),
+                    'total': sum(seconds),
+                    'mean': sum(seconds) / len(seconds),
+                    'p50': seconds[(len(seconds) - 1) // 2],
+                    'p95': seconds[int(0.95 * (len(seconds) - 1))],
+                }
+            return {
+                'timings': timings,
+                'counters': dict(self.counters),
+                'values': dict((name, dict(counts)) for name, counts in self.values.items()),
+            }
+
+def extractFromHTML(html, blur=5, extractor=None, parser=None, normalize=False, stats=None, limits=None, template=None,
+                    steps=None):
     """
     Extracts text from HTML content.
+
+    If an existing TextExtractor is given, it will be reset and reused
+    instead of creating a new one. The parser names the backend used to
+    parse the HTML, one of PARSER_BACKENDS or 'auto'. If normalize is true,
+    common markup errors are corrected while parsing, see TagBalancer.
+    If an ExtractStats is given, the parse, score and cleanup stages are
+    recorded in it. If an ExtractLimits is given, its budgets are applied,
+    and if any are hit, the text found so far is returned and the budget is
+    named by the extractor's truncated attribute. If a template path is
+    given, only the text under it is scored, see TextExtractor.set_template().
+    The text is normalized by the given cleanup steps, functions taking and
+    returning the text, CLEANUP_STEPS by default.
     """
 
     #html = html.encode('utf-8', errors='ignore')
@@ -309,30 +1481,528 @@ def extractFromHTML(html, blur=5):
         pass
     assert isinstance(html, unicode)
 
-    # Create memory file.
-    _file = StringIO()
-
     # Convert html to text.
-    f = formatter.AbstractFormatter(formatter.DumbWriter(_file))
-    p = TextExtractor()
+    if stats is None:
+        stats = NULL_STATS
+    p = _get_extractor(extractor, blur, limits)
+    if template is not None:
+        p.set_template(template)
+    _parse_html(p, html, parser, normalize, stats, limits)
+    return _get_cleaned_text(p, stats, steps)
+
+def extract_blurs(html, blurs=(3, 5, 7), extractor=None, parser=None, normalize=False, stats=None, limits=None,
+                  steps=None):
+    """
+    Extracts text from HTML content at each of the given blurs, parsing it
+    only once.
+
+    Returns an OrderedDict of {blur: text}, in the order of the blurs. Each
+    text is the same as extractFromHTML() returns for that blur. The other
+    parameters are as for extractFromHTML().
+
+    Raises a ValueError if no blurs are given, or one isn't an integer.
+    """
+    try:
+        html = unicode(html, errors='ignore')
+    except TypeError:
+        pass
+    assert isinstance(html, unicode)
+
+    if stats is None:
+        stats = NULL_STATS
+    blurs = tuple(int(blur) for blur in blurs)
+    if not blurs:
+        raise ValueError('At least one blur must be given.')
+    p = _get_extractor(extractor, blurs[0], limits)
+    p.pathBlurs = blurs
+    _parse_html(p, html, parser, normalize, stats, limits)
+    return _get_cleaned_texts(p, stats, blurs, steps)
+
+def record_text_nodes(html, parser=None, normalize=False, limits=None):
+    """
+    Parses HTML content and returns its TextNodeStream, which can be stored
+    and scored again later without re-parsing. The parameters are as for
+    extractFromHTML().
+    """
+    try:
+        html = unicode(html, errors='ignore')
+    except TypeError:
+        pass
+    assert isinstance(html, unicode)
+
+    p = TextNodeRecorder()
+    p.set_limits(DEFAULT_LIMITS if limits is None else limits)
+    _parse_html(p, html, parser, normalize, NULL_STATS, limits)
+    return p.get_text_nodes()
+
+def _parse_html(p, html, parser, normalize, stats, limits):
+    with stats.timer('parse'):
+        if limits is not None and limits.max_bytes is not None and len(html) > limits.max_bytes:
+            html = html[:limits.max_bytes]
+            p.truncated = 'bytes'
+        html_parser = create_parser(p, parser, normalize=normalize)
+        try:
+            html_parser.feed(html)
+            html_parser.close()
+        except StopParsing:
+            pass
+
+def _get_cleaned_text(p, stats, steps=None):
+    if steps is None:
+        steps = CLEANUP_STEPS
+    if stats is NULL_STATS:
+        return p.get_plaintext(steps)
+    return _get_cleaned_texts(p, stats, (p.pathBlur,), steps)[p.pathBlur]
+
+def _get_cleaned_texts(p, stats, blurs, steps=None):
+    if steps is None:
+        steps = CLEANUP_STEPS
+    texts = OrderedDict()
+    if stats is NULL_STATS:
+        for blur in blurs:
+            texts[blur] = p.get_plaintext(steps, blur)
+        return texts
+    if p.truncated:
+        stats.set('truncated', p.truncated)
+    stats.incr('text_nodes', len(p.texts))
+    for blur in blurs:
+        stats.incr('paths', len(p.get_path_texts(blur)))
+        with stats.timer('score'):
+            path = p.get_best_path(blur)
+        with stats.timer('cleanup'):
+            texts[blur] = '' if path is None else clean_text_list(p.get_text_list(path, blur), steps)
+    return texts
+
+def _get_extractor(extractor, blur, limits=None):
+    if extractor is None:
+        p = TextExtractor()
+    else:
+        p = extractor
+        p.reset()
     p.pathBlur = blur
-    p.feed(html)
-    p.close()
-    text = p.get_plaintext()
+    p.pathBlurs = None
+    p.set_limits(DEFAULT_LIMITS if limits is None else limits)
+    return p
 
-    # Remove stand-alone punctuation.
-    text = re.sub("\s[\(\),;\.\?\!](?=\s)", " ", text).strip()
+def extractFromChunks(chunks, encoding='utf-8', errors='ignore', blur=5, max_bytes=None, extractor=None, parser=None, normalize=False, stats=None, limits=None):
+    """
+    Extracts text from HTML given as an iterable of chunks, so the document
+    never has to be held in memory as a whole.
+
+    Chunks of bytes are decoded incrementally with the given encoding, and
+    chunks of text are used as-is. Each chunk is fed to the extractor as
+    soon as it's read. If max_bytes is given, reading stops once more than
+    that many bytes have been seen and the text found so far is returned.
+    Chunks of text are measured by their size in UTF-8.
+    """
+    if stats is None:
+        stats = NULL_STATS
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    p = _get_extractor(extractor, blur, limits)
+    if max_bytes is None and limits is not None:
+        max_bytes = limits.max_bytes
+    html_parser = create_parser(p, parser, normalize=normalize)
+    total = 0
+    # Since the chunks may be downloaded as they're read, this includes the
+    # time spent waiting for them.
+    with stats.timer('parse'):
+        try:
+            for chunk in chunks:
+                size = len(chunk.encode('utf-8')) if isinstance(chunk, unicode) else len(chunk)
+                if max_bytes is not None and total + size > max_bytes:
+                    html_parser.feed(_decode_chunk(decoder, _truncate_chunk(chunk, max_bytes - total)))
+                    total = max_bytes
+                    p.truncated = p.truncated or 'bytes'
+                    break
+                total += size
+                html_parser.feed(_decode_chunk(decoder, chunk))
+            html_parser.feed(decoder.decode(b'', True))
+            html_parser.close()
+        except StopParsing:
+            pass
+    stats.incr('bytes', total)
+    return _get_cleaned_text(p, stats)
 
-    # Compress whitespace.
-    text = re.sub("[\n\s]+", " ", text).strip()
+def _truncate_chunk(chunk, size):
+    # Cuts a chunk to its first size bytes, dropping any character cut in two.
+    if isinstance(chunk, unicode):
+        return chunk.encode('utf-8')[:size].decode('utf-8', 'ignore')
+    return chunk[:size]
 
-    # Remove consequetive dashes.
-    text = re.sub("\-{2,}", "", text).strip()
+def _decode_chunk(decoder, chunk):
+    if isinstance(chunk, unicode):
+        return chunk
+    return decoder.decode(chunk)
 
-    # Remove consequetive periods.
-    text = re.sub("\.{2,}", "", text).strip()
+def iter_file_chunks(f, chunk_size=65536):
+    """
+    Yields the contents of a file-like object in chunks.
+    """
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
 
-    return text
+def extractFromFile(f,
+    encoding='utf-8',
+    errors='ignore',
+    blur=5,
+    max_bytes=None,
+    chunk_size=65536,
+    extractor=None,
+    parser=None,
+    normalize=False,
+    stats=None,
+    limits=None):
+    """
+    Extracts text from a file-like object containing HTML, reading it in
+    chunks. See extractFromChunks().
+    """
+    return extractFromChunks(
+        iter_file_chunks(f, chunk_size),
+        encoding=encoding,
+        errors=errors,
+        blur=blur,
+        max_bytes=max_bytes,
+        extractor=extractor,
+        parser=parser,
+        normalize=normalize,
+        stats=stats,
+        limits=limits)
+
+class ExtractorPool(object):
+    """
+    A thread-safe pool of reusable TextExtractors, so a long-running
+    process doesn't allocate a new parser for every document.
+
+    Parameters:
+    max_size := int
+        The most idle extractors to keep. Extractors released while the pool
+        is full are discarded. If None, the pool is unbounded, and grows to
+        the largest number of extractors used at once.
+    blur := int
+        The default blur used by extract().
+    """
+
+    def __init__(self, max_size=None, blur=5):
+        self.max_size = max_size
+        self.blur = blur
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self):
+        """
+        Returns an idle extractor, creating one if none are available.
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+        return TextExtractor()
+
+    def release(self, extractor):
+        """
+        Resets the extractor, dropping its references to the last document,
+        and returns it to the pool.
+        """
+        extractor.reset()
+        with self._lock:
+            if self.max_size is None or len(self._idle) < self.max_size:
+                self._idle.append(extractor)
+
+    @contextlib.contextmanager
+    def extractor(self):
+        """
+        Context manager that acquires an extractor and releases it on exit.
+        """
+        extractor = self.acquire()
+        try:
+            yield extractor
+        finally:
+            self.release(extractor)
+
+    def extract(self, html, blur=None, parser=None, normalize=False, stats=None, limits=None, steps=None):
+        """
+        Extracts text from HTML content with a pooled extractor.
+        See extractFromHTML().
+        """
+        with self.extractor() as extractor:
+            return extractFromHTML(
+                html,
+                blur=self.blur if blur is None else blur,
+                extractor=extractor,
+                parser=parser,
+                normalize=normalize,
+                stats=stats,
+                limits=limits,
+                steps=steps)
+
+def get_domain(url):
+    """
+    Returns the lowercase host name of a URL.
+    """
+    return (urlparse.urlsplit(url).hostname or '').lower()
+
+class TemplateStore(object):
+    """
+    Remembers the path whose text wins on each domain, since pages from the
+    same site usually share a layout, so later pages can be extracted by
+    scoring only that path, and parsing stops once it's closed.
+
+    A domain's template is used once the same path has won a number of full
+    extractions in a row. A templated extraction whose text is much shorter
+    than usual for the domain, e.g. because the page has another layout, is
+    redone with full scoring, and if another path wins, the template is
+    replaced. Every so often a page is fully scored anyway, to check the
+    template still wins. Since paths depend on how the page is parsed,
+    templates are kept per blur, parser backend and normalize setting.
+
+    Parameters:
+    min_confidence := int
+        The number of full extractions in a row the same path must win
+        before it's used as a template.
+    min_length_ratio := float
+        The fraction of the domain's average text length below which the
+        text found with a template isn't trusted.
+    verify_every := int
+        The number of templated extractions between full ones.
+    max_domains := int
+        The most domains remembered, the least recently used being
+        forgotten first.
+    """
+
+    def __init__(self, min_confidence=3, min_length_ratio=0.5, verify_every=50, max_domains=10000):
+        self.min_confidence = min_confidence
+        self.min_length_ratio = min_length_ratio
+        self.verify_every = verify_every
+        self.max_domains = max_domains
+        # {(domain, blur, parser, normalize): {path, confidence, length, since_verified}}
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._templates)
+
+    def _get_key(self, domain, blur, parser, normalize):
+        return (domain, int(blur), get_parser_name(parser), bool(normalize))
+
+    def get_template(self, domain, blur, parser=None, normalize=False):
+        """
+        Returns the path to score on pages from the domain, or None if they
+        should be fully scored.
+        """
+        key = self._get_key(domain, blur, parser, normalize)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None \
+                or template['confidence'] < self.min_confidence \
+                or template['since_verified'] >= self.verify_every:
+                return None
+            return template['path']
+
+    def is_plausible(self, domain, blur, text, parser=None, normalize=False):
+        """
+        Returns true if text found with the domain's template is long enough
+        to trust.
+        """
+        key = self._get_key(domain, blur, parser, normalize)
+        with self._lock:
+            template = self._templates.get(key)
+            return template is not None and len(text) >= self.min_length_ratio * template['length']
+
+    def update(self, domain, blur, path, length, templated=False, parser=None, normalize=False):
+        """
+        Records the path that won on a page from the domain, and the length
+        of its text.
+        """
+        key = self._get_key(domain, blur, parser, normalize)
+        with self._lock:
+            template = self._templates.pop(key, None)
+            if template is None or template['path'] != path:
+                template = dict(path=path, confidence=0, length=length, since_verified=0)
+            template['length'] = 0.8 * template['length'] + 0.2 * length
+            if templated:
+                template['since_verified'] += 1
+            else:
+                template['confidence'] += 1
+                template['since_verified'] = 0
+            # Re-insert to mark it as the most recently used.
+            self._templates[key] = template
+            while len(self._templates) > self.max_domains:
+                self._templates.popitem(last=False)
+
+    def extract(self, url, html, blur=5, extractor=None, parser=None, normalize=False, stats=None, limits=None):
+        """
+        Extracts text from HTML content downloaded from the URL, using the
+        template of its domain if there's a trusted one. The other parameters
+        are as for extractFromHTML().
+        """
+        if stats is None:
+            stats = NULL_STATS
+        domain = get_domain(url)
+        p = extractor or TextExtractor()
+        template = self.get_template(domain, blur, parser, normalize)
+        if template is not None:
+            text = extractFromHTML(
+                html, blur=blur, extractor=p, parser=parser, normalize=normalize,
+                stats=stats, limits=limits, template=template)
+            if not p.truncated and self.is_plausible(domain, blur, text, parser, normalize):
+                with self._lock:
+                    self.hits += 1
+                stats.incr('template_hits')
+                self.update(domain, blur, template, len(text), templated=True, parser=parser, normalize=normalize)
+                return text
+            stats.incr('template_fallbacks')
+        with self._lock:
+            self.misses += 1
+        text = extractFromHTML(
+            html, blur=blur, extractor=p, parser=parser, normalize=normalize, stats=stats, limits=limits)
+        if not p.truncated:
+            best = p.get_best_path()
+            if best is not None:
+                self.update(domain, blur, p.get_path(best), len(text), parser=parser, normalize=normalize)
+        return text
+
+    def save(self, f):
+        """
+        Writes the templates as JSON to a file-like object.
+        """
+        with self._lock:
+            templates = [
+                dict(template, domain=domain, blur=blur, parser=parser, normalize=normalize)
+                for (domain, blur, parser, normalize), template in self._templates.items()
+            ]
+        json.dump(templates, f)
+
+    def load(self, f):
+        """
+        Reads templates written by save() from a file-like object.
+        """
+        for template in json.load(f):
+            # Templates saved before the parser was recorded used the defaults.
+            key = self._get_key(
+                template.pop('domain'), template.pop('blur'), template.pop('parser', None),
+                template.pop('normalize', False))
+            template['path'] = tuple(template['path'])
+            with self._lock:
+                self._templates[key] = template
+
+ExtractResult = namedtuple('ExtractResult', ['index', 'text', 'error'])
+
+# The extractor reused by each extract_many() worker process.
+_worker_extractor = None
+
+def _init_extract_worker():
+    global _worker_extractor # pylint: disable=global-statement
+    _worker_extractor = TextExtractor()
+
+def _extract_worker(args):
+    index, html, blur, parser, limits = args
+    try:
+        text = extractFromHTML(html, blur=blur, extractor=_worker_extractor, parser=parser, limits=limits)
+        return ExtractResult(index, text, None)
+    except Exception as e:
+        return ExtractResult(index, None, '%s: %s' % (type(e).__name__, e))
+
+def extract_many(htmls, workers=None, chunksize=16, ordered=True, blur=5, parser=None, limits=None):
+    """
+    Extracts text from many HTML documents using a pool of worker processes.
+
+    Parameters:
+    htmls := iterable of strings
+        The HTML documents to extract text from. It's consumed lazily, so it
+        may be a generator over a corpus too large to fit in memory.
+    workers := int
+        The number of worker processes. Defaults to the number of CPUs.
+        If 1 or less, documents are extracted in the current process.
+    chunksize := int
+        The number of documents sent to a worker at a time.
+    ordered := bool
+        True=yield results in the same order as the input
+        False=yield results as soon as they're ready
+    parser := str
+        The parser backend to use, see create_parser().
+    limits := ExtractLimits
+        The budgets applied to each document, so one pathological document
+        can't stall a worker.
+
+    Yields an ExtractResult(index, text, error) per document, where index is
+    the position of the document in the input. If extracting a document
+    fails, its text is None and error describes the exception, and the rest
+    of the batch is unaffected.
+    """
+    import multiprocessing
+
+    tasks = ((index, html, blur, parser, limits) for index, html in enumerate(htmls))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        _init_extract_worker()
+        for task in tasks:
+            yield _extract_worker(task)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=_init_extract_worker)
+    try:
+        if ordered:
+            results = pool.imap(_extract_worker, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(_extract_worker, tasks, chunksize)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Matches start and end tags, capturing the slash of end tags, the tag name
+# and the slash of self-closing tags.
+TAG_PATTERN = re.compile(br'<(/?)([a-zA-Z][a-zA-Z0-9]*)(?:\s[^<>]*?)?(/?)>')
+
+# The fraction of unbalanced tags above which HTML is considered too
+# malformed for TagBalancer to fix, and the fewest unbalanced tags needed,
+# so a single stray tag in a small page doesn't count.
+MALFORMED_THRESHOLD = 0.05
+MALFORMED_MIN_TAGS = 3
+
+def is_malformed_html(html):
+    """
+    Quickly estimates whether HTML is too malformed to be parsed without
+    running it through tidy first.
+
+    Counts the start and end tags of each element, ignoring the ones
+    TagBalancer corrects for (void elements and those with optional end
+    tags), and returns true if the fraction left unbalanced exceeds
+    MALFORMED_THRESHOLD.
+    """
+    if isinstance(html, unicode):
+        html = html.encode('utf-8', 'ignore')
+    counts = defaultdict(int)
+    total = 0
+    for is_end, tag, self_closing in TAG_PATTERN.findall(html):
+        if self_closing:
+            continue
+        tag = tag.lower().decode('ascii')
+        if tag in VOID_TAGS or tag in IMPLIED_END_TAGS:
+            continue
+        counts[tag] += -1 if is_end else 1
+        total += 1
+    unbalanced = sum(abs(n) for n in counts.values())
+    return unbalanced >= MALFORMED_MIN_TAGS and unbalanced > total * MALFORMED_THRESHOLD
+
+# The choices for the tidy option of extractFromURL().
+TIDY_ALWAYS = 'always'
+TIDY_AUTO = 'auto'
+TIDY_NEVER = 'never'
+TIDY_CHOICES = (TIDY_ALWAYS, TIDY_AUTO, TIDY_NEVER)
 
 def tidyHTML(dirtyHTML):
     """
@@ -364,93 +2034,851 @@ def generate_key(s, pattern="%s.txt"):
     h.update(s.encode('utf-8'))
     return pattern % h.hexdigest()
 
-def cache_get(cache_dir, cache_key, default=None):
+class FileCache(object):
     """
-    Returns the content of a cache item or the given default
+    An on-disk cache of content keyed by generate_key().
+
+    Since keys are hashes, entries are spread over nested shard directories
+    named after the leading characters of the key, e.g. ab/cd/abcdef...txt,
+    so no single directory grows to millions of entries. Writes go to a
+    temporary file which is then renamed into place, so readers never see
+    a partially written entry.
+
+    Parameters:
+    cache_dir := str
+        The root directory of the cache.
+    max_size := int
+        The most bytes the cache may hold. When exceeded, the least recently
+        used entries are evicted until it's back under the low-water mark.
+    max_age := int
+        The most seconds since an entry was written before it's evicted.
+    levels := int
+        The number of nested shard directories.
     """
-    filename = os.path.join(cache_dir, cache_key)
 
-    if os.path.isfile(filename):
-        with open(filename, 'r') as f:
-            return f.read()
+    # The fraction of max_size eviction frees the cache down to, so that
+    # evictions don't run on every write once the cache is full.
+    low_water = 0.9
+
+    # Permissions of created directories, '-rwxr-x---'.
+    dir_perms = 488
+
+    def __init__(self, cache_dir='_cache', max_size=None, max_age=None, levels=2):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+        self.levels = levels
+        self._lock = threading.Lock()
+        self._size = None # total bytes stored, counted on first need
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_path(self, key):
+        """
+        Returns the filename an entry is stored under.
+        """
+        shards = [key[i*2:i*2+2] for i in range(self.levels)]
+        return os.path.join(self.cache_dir, *(shards + [key]))
+
+    def _count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def _migrate(self, key):
+        """
+        Moves an entry written by older versions, directly in the cache
+        directory, into its shard. Returns true if one was found.
+        """
+        legacy_filename = os.path.join(self.cache_dir, key)
+        if not os.path.isfile(legacy_filename):
+            return False
+        filename = self.get_path(key)
+        self._makedirs(os.path.dirname(filename))
+        try:
+            _replace_file(legacy_filename, filename)
+        except OSError:
+            return False
+        return True
+
+    def _makedirs(self, dirname):
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname, self.dir_perms)
+            except OSError:
+                # Another process may have created it first.
+                if not os.path.isdir(dirname):
+                    raise
+
+    def get(self, key, default=None):
+        """
+        Returns the content of a cache entry as bytes, or the given default.
+        """
+        filename = self.get_path(key)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            if not self._migrate(key):
+                self._count('misses')
+                return default
+            stat = os.stat(filename)
+
+        if self.max_age is not None and stat.st_mtime < time.time() - self.max_age:
+            self.delete(key)
+            self._count('evictions')
+            self._count('misses')
+            return default
 
-    return default
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read()
+            # Record the access time for LRU eviction, keeping the mtime,
+            # which marks when the entry was written.
+            os.utime(filename, (time.time(), stat.st_mtime))
+        except (IOError, OSError):
+            # It was evicted by someone else since we checked.
+            self._count('misses')
+            return default
+        self._count('hits')
+        return content
+
+    def get_mtime(self, key):
+        """
+        Returns the time an entry was written, or 0 if it does not exist.
+        """
+        filename = self.get_path(key)
+        if not os.path.exists(filename) and not self._migrate(key):
+            return 0
+        return os.path.getmtime(filename)
+
+    def set(self, key, content):
+        """
+        Atomically writes a cache entry.
+        """
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        filename = self.get_path(key)
+        dirname = os.path.dirname(filename)
+        self._makedirs(dirname)
+        old_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+
+        fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            _replace_file(tmp_filename, filename)
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+        if self.max_size is not None:
+            with self._lock:
+                if self._size is not None:
+                    self._size += len(content) - old_size
+            if self.get_size() > self.max_size:
+                self.evict()
+
+    def delete(self, key):
+        try:
+            size = os.path.getsize(self.get_path(key))
+            os.remove(self.get_path(key))
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def _iter_entries(self):
+        """
+        Yields (filename, stat) for every entry in the cache.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                if name.startswith('.tmp-'):
+                    continue
+                filename = os.path.join(dirpath, name)
+                try:
+                    yield filename, os.stat(filename)
+                except OSError:
+                    pass
+
+    def get_size(self):
+        """
+        Returns the total bytes stored in the cache.
+        """
+        with self._lock:
+            size = self._size
+        if size is None:
+            size = sum(stat.st_size for _, stat in self._iter_entries())
+            with self._lock:
+                self._size = size
+        return size
+
+    def evict(self):
+        """
+        Removes entries older than max_age, and then the least recently used
+        entries until the cache is under the low-water mark of max_size.
+        Returns the number of entries removed.
+        """
+        entries = []
+        size = 0
+        evicted = 0
+        expiration = None if self.max_age is None else time.time() - self.max_age
+        for filename, stat in self._iter_entries():
+            if expiration is not None and stat.st_mtime < expiration:
+                if _remove_file(filename):
+                    evicted += 1
+                continue
+            entries.append((stat.st_atime, stat.st_size, filename))
+            size += stat.st_size
+
+        if self.max_size is not None and size > self.max_size:
+            target = self.max_size * self.low_water
+            entries.sort()
+            for _, entry_size, filename in entries:
+                if size <= target:
+                    break
+                if _remove_file(filename):
+                    evicted += 1
+                    size -= entry_size
+
+        with self._lock:
+            self._size = size
+            self.evictions += evicted
+        return evicted
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the hit, miss and eviction counters.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+def _replace_file(src, dst):
+    # os.replace() is atomic on all platforms, but is only on Python 3.
+    getattr(os, 'replace', os.rename)(src, dst)
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+        return True
+    except OSError:
+        return False
+
+_file_caches = {} # {cache_dir: FileCache}
+_file_caches_lock = threading.Lock()
+
+def get_cache(cache, cache_dir='_cache'):
+    """
+    Returns the cache backend for a `cache` option, which may be False for
+    no cache, True for the shared FileCache of the cache directory, or any
+    object with the same get(), get_mtime() and set() methods as FileCache.
+    """
+    if not cache:
+        return None
+    if cache is not True:
+        return cache
+    with _file_caches_lock:
+        key = os.path.abspath(cache_dir)
+        if key not in _file_caches:
+            _file_caches[key] = FileCache(cache_dir)
+        return _file_caches[key]
+
+def cache_get(cache_dir, cache_key, default=None):
+    """
+    Returns the content of a cache item or the given default
+    """
+    return get_cache(True, cache_dir).get(cache_key, default)
 
 def cache_set(cache_dir, cache_key, content):
     """
     Creates a new cache file in the cache directory
     """
-    filename = os.path.join(cache_dir, cache_key)
-
-    with open(filename, 'w') as f:
-        f.write(content)
+    get_cache(True, cache_dir).set(cache_key, content)
 
 def cache_info(cache_dir, cache_key):
     """
     Returns the cache files mtime or 0 if it does not exists
     """
-    filename = os.path.join(cache_dir, cache_key)
-    return os.path.getmtime(filename) if os.path.exists(filename) else 0
+    return get_cache(True, cache_dir).get_mtime(cache_key)
+
+# Bump when a change alters the text extracted from the same HTML, so text
+# cached by older versions isn't reused.
+EXTRACTOR_VERSION = 3
+
+# The response headers saved along with a cached page.
+CACHED_HEADERS = ('content-type', 'etag', 'last-modified', 'cache-control')
+
+# The parameters of extractFromURL() that change the extracted text.
+TEXT_KEY_PARAMS = (('blur', 5), ('filters', None), ('tidy', TIDY_ALWAYS), ('parser', None))
+
+# Pages are cached in three layers, so that the same content reached from
+# different URLs, or extracted with different parameters, only repeats the
+# work that differs:
+#
+#   url -> page info: the content hash, resolved encoding and the headers
+#   url -> raw page
+#   content hash + filters -> tidied page
+#   content hash + extractor version + encoding + parameters -> text
+
+def get_content_hash(content):
+    """
+    Returns the hash identifying the raw content of a page in the cache.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+def _get_page_info(cache, url):
+    info = cache.get(generate_key(url, "%s.page"))
+    if info is None:
+        return None
+    try:
+        return json.loads(info.decode('utf-8'))
+    except ValueError:
+        return None
+
+def _set_page_info(cache, url, content_hash, encoding, headers, raw, fetched):
+    info = {
+        'hash': content_hash,
+        'encoding': encoding,
+        'headers': _get_cached_headers(headers),
+        'raw': raw,
+        'fetched': fetched,
+    }
+    cache.set(generate_key(url, "%s.page"), json.dumps(info, sort_keys=True))
+
+def _get_cached_headers(headers):
+    return dict(
+        (name, headers[name])
+        for name in CACHED_HEADERS
+        if headers and headers.get(name)
+    )
+
+CACHE_CONTROL_MAX_AGE_PATTERN = re.compile(r'max-age\s*=\s*"?(\d+)', re.I)
+
+class FreshnessPolicy(object):
+    """
+    Decides how long a cached page is used before it's revalidated with the
+    server, using a conditional request that only downloads the page again if
+    it has changed.
+
+    Parameters:
+    max_age := int
+        The seconds a cached page is used without revalidating it.
+        None=forever, 0=always revalidate.
+    use_cache_control := bool
+        True=use the max-age in the page's Cache-Control header in place of
+            max_age when given, and always revalidate pages marked no-cache
+            or no-store.
+    """
 
-def fetch(url, timeout=5, userAgent=None, only_mime_types=None):
+    def __init__(self, max_age=None, use_cache_control=False):
+        self.max_age = max_age
+        self.use_cache_control = use_cache_control
+
+    def get_max_age(self, info):
+        """
+        Returns the seconds the cached page described by the info may be used.
+        """
+        if self.use_cache_control:
+            cache_control = info['headers'].get('cache-control', '').lower()
+            if 'no-cache' in cache_control or 'no-store' in cache_control:
+                return 0
+            match = CACHE_CONTROL_MAX_AGE_PATTERN.search(cache_control)
+            if match:
+                return int(match.group(1))
+        return self.max_age
+
+    def is_fresh(self, info, now=None):
+        """
+        Returns true if the cached page can be used without revalidating it.
+        """
+        max_age = self.get_max_age(info)
+        if max_age is None:
+            return True
+        now = time.time() if now is None else now
+        return now - info.get('fetched', 0) < max_age
+
+def get_freshness_policy(freshness):
     """
-    Retrieves the raw content of the URL.
+    Returns a FreshnessPolicy, given one or the max age in seconds.
+    """
+    if isinstance(freshness, FreshnessPolicy):
+        return freshness
+    return FreshnessPolicy(max_age=freshness)
+
+def get_conditional_headers(info):
+    """
+    Returns the request headers that revalidate the cached page described by
+    the info, or None if it has no validators.
     """
     headers = {}
-    if userAgent:
-        headers['User-agent'] = str(userAgent)
-    else:
-        headers['User-agent'] = ua.random
-
-    #request = Request(url=url, headers=headers)
-    #response = urlopen(request, timeout=timeout)
-    response = requests.get(url, headers=headers, timeout=timeout)
-
-    # Return nothing of the content isn't one of the target mime-types.
-    if only_mime_types:
-        assert isinstance(only_mime_types, (tuple, list))
-        # Check for mimetype by looking at pattern in the URL.
-        # Not super accurate, but very fast.
-        ct, mt_encoding = mimetypes.guess_type(url)
-        # Then check for mimetype by actually requesting the resource and
-        # looking at the response.
-        # More accurate, but slower since we actually have to send a request.
-        if not ct:
-            response_info = response.info()
-            ct = (response_info.getheader('Content-Type') or '').split(';')[0]
-        #TODO:if still undefined, use magic.Magic(mime=True).from_file(url)?
-        if ct not in only_mime_types:
-            return
+    if info['headers'].get('etag'):
+        headers['If-None-Match'] = info['headers']['etag']
+    if info['headers'].get('last-modified'):
+        headers['If-Modified-Since'] = info['headers']['last-modified']
+    return headers or None
+
+def _get_tidy_key(content_hash, filters):
+    return generate_key('%s|%s' % (content_hash, filters or ''), "%s.tidy")
+
+def _get_text_key(content_hash, encoding, params, stream=False):
+    values = [EXTRACTOR_VERSION, content_hash, encoding]
+    for name, default in TEXT_KEY_PARAMS:
+        value = params.get(name, default)
+        if name == 'blur':
+            value = int(value)
+        elif name == 'parser':
+            value = get_parser_name(value)
+        elif name == 'tidy' and stream:
+            # Streaming always uses the normalizer.
+            value = 'stream'
+        values.append(value)
+    return generate_key('|'.join('%s' % value for value in values), "%s.txt")
+
+# Byte order marks and the encodings they imply. UTF-32 is checked first
+# since its little-endian mark starts with the UTF-16 one.
+# The UTF-16 and UTF-32 codecs remove their byte order mark when decoding,
+# but only utf-8-sig removes UTF-8's.
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+
+META_CHARSET_PATTERN = re.compile(br'<meta[^>]+?charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+
+# The number of bytes at the start of a page searched for a <meta> charset.
+# Browsers only look at the first 1024, but pages with large heads often
+# declare it later.
+META_SAMPLE_SIZE = 32768
+
+# The number of bytes at the start of a page given to chardet, if the
+# encoding isn't declared.
+CHARDET_SAMPLE_SIZE = 32768
+
+# The encoding used when none is declared and it can't be detected.
+DEFAULT_ENCODING = 'utf-8'
+
+ENCODING_SOURCES = ('bom', 'header', 'meta', 'chardet', 'default')
+
+def _lookup_encoding(name):
+    if isinstance(name, bytes):
+        name = name.decode('ascii', 'ignore')
     try:
-        #return response.read()
-        return response.text
-    except httplib.IncompleteRead as e:
-        # This should rarely happen, and is often the fault of the server
-        # sending a malformed response.
-        #TODO:just abandon all content and return '' instead?
-        return e.partial
-
-def check_robotstxt(url, useCache, cache_dir, userAgent=None):
-    scheme, netloc, url_path, query, fragment = urlparse.urlsplit(url)
-    robotstxt_url = urlparse.urlunsplit((
-        scheme,
-        netloc,
-        '/robots.txt',
-        '',
-        '',
-    ))
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def _get_detector():
+    try:
+        import cchardet as chardet
+    except ImportError:
+        try:
+            import chardet
+        except ImportError as e:
+            raise ImportError(("%s\nYou need to install chardet.\n" + \
+                 "e.g. sudo pip install chardet") % e)
+    return chardet.detect
+
+class EncodingResolver(object):
+    """
+    Determines the encoding of a page from the cheapest source that states
+    it: a byte order mark, the Content-Type response header, or a <meta>
+    tag near the start of the page. Only if none do is chardet (or cchardet,
+    if installed) run, and then only on a sample of the page.
+
+    Counts how often each source decided the encoding.
+    """
+
+    def __init__(self, meta_sample_size=META_SAMPLE_SIZE, chardet_sample_size=CHARDET_SAMPLE_SIZE):
+        self.meta_sample_size = meta_sample_size
+        self.chardet_sample_size = chardet_sample_size
+        self._lock = threading.Lock()
+        self.counts = dict((source, 0) for source in ENCODING_SOURCES)
+
+    def resolve(self, content, headers=None):
+        """
+        Returns a tuple of (encoding, source) for the raw content, where
+        source is one of ENCODING_SOURCES.
+
+        Parameters:
+        content := bytes
+            The raw page, or at least its first chunk.
+        headers := dict
+            The response headers, if any.
+        """
+        encoding, source = self._resolve(content, headers)
+        with self._lock:
+            self.counts[source] += 1
+        return encoding, source
+
+    def _resolve(self, content, headers):
+        for bom, encoding in BOMS:
+            if content.startswith(bom):
+                return encoding, 'bom'
+
+        content_type = (headers or {}).get('content-type')
+        if content_type:
+            match = CHARSET_PATTERN.search(content_type)
+            encoding = match and _lookup_encoding(match.group(1))
+            if encoding:
+                return encoding, 'header'
+
+        match = META_CHARSET_PATTERN.search(content[:self.meta_sample_size])
+        encoding = match and _lookup_encoding(match.group(1))
+        if encoding:
+            # A page that could be read well enough to find the tag can't be
+            # UTF-16, so such a declaration is wrong, per the HTML5 spec.
+            if encoding.startswith('utf-16'):
+                encoding = 'utf-8'
+            return encoding, 'meta'
+
+        detect = _get_detector()
+        encoding = _lookup_encoding(detect(content[:self.chardet_sample_size])['encoding'] or '')
+        if encoding == 'ascii':
+            # The rest of the page may not be, so assume the superset.
+            encoding = 'utf-8'
+        if encoding:
+            return encoding, 'chardet'
+        return DEFAULT_ENCODING, 'default'
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the number of encodings decided by each source.
+        """
+        with self._lock:
+            return dict(self.counts)
+
+default_encoding_resolver = EncodingResolver()
+
+def resolve_encoding(content, headers=None):
+    """
+    Returns a tuple of (encoding, source) for the raw content of a page,
+    using the default EncodingResolver.
+    """
+    return default_encoding_resolver.resolve(content, headers)
+
+# The undecoded content of a downloaded page, with its response headers and
+# the time it was downloaded.
+RawPage = namedtuple('RawPage', ['content', 'headers', 'fetched'])
+
+class Fetcher(object):
+    """
+    Retrieves URLs over a persistent requests.Session, so that repeated
+    requests to the same host reuse a pooled keep-alive connection instead
+    of paying for a new TCP and TLS handshake each time.
+
+    Parameters:
+    pool_connections := int
+        The number of hosts to keep connection pools for.
+    pool_maxsize := int
+        The maximum number of connections to keep open per host.
+    retries := int
+        The number of times to retry a request after a connection error
+        or a 5xx response.
+    backoff_factor := float
+        The base delay, in seconds, of the exponential backoff between
+        retries.
+    """
+
+    # Responses with these statuses are retried.
+    retry_statuses = (500, 502, 503, 504)
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, retries=2, backoff_factor=0.5):
+        import requests
+        from requests.adapters import HTTPAdapter
+        try:
+            from urllib3.util.retry import Retry
+        except ImportError:
+            from requests.packages.urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=self.retry_statuses,
+            raise_on_status=False)
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self._lock = threading.Lock()
+        # {connection pool: (connections opened, requests made)} as of the
+        # last time the pool's counters were read.
+        self._pool_counts = weakref.WeakKeyDictionary()
+        self.pool_hits = 0
+        self.pool_misses = 0
+
+    def get(self, url, timeout=5, userAgent=None, headers=None, stream=False):
+        """
+        Sends a GET request for the URL and returns the response.
+
+        If stream is true, the response body isn't read until it's accessed,
+        e.g. with response.iter_content().
+        """
+        headers = dict(headers or {})
+        if userAgent:
+            headers['User-agent'] = str(userAgent)
+        else:
+            headers['User-agent'] = get_random_useragent()
+        response = self.session.get(url, headers=headers, timeout=timeout, stream=stream)
+        self._count_pool_usage()
+        return response
+
+    def _count_pool_usage(self):
+        """
+        Updates the pool hit and miss counters from the counters kept by each
+        of the session's connection pools.
+        """
+        pools = self.adapter.poolmanager.pools
+        with self._lock:
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections0, requests0 = self._pool_counts.get(pool, (0, 0))
+                new_connections = pool.num_connections - connections0
+                new_requests = pool.num_requests - requests0
+                self._pool_counts[pool] = (pool.num_connections, pool.num_requests)
+                self.pool_misses += new_connections
+                self.pool_hits += max(0, new_requests - new_connections)
+
+    def get_stats(self):
+        """
+        Returns a dictionary of the connection pool counters, where a hit is a
+        request sent over an already open connection and a miss is a request
+        that had to open a new connection.
+        """
+        with self._lock:
+            return {'pool_hits': self.pool_hits, 'pool_misses': self.pool_misses}
+
+    def fetch(self, url, timeout=5, userAgent=None, only_mime_types=None, decode=True):
+        """
+        Retrieves the raw content of the URL.
+
+        If decode is false, the content is returned undecoded as a RawPage,
+        so its encoding can be resolved by the caller.
+        """
+        from six.moves import http_client as httplib
+
+        response = self.get(url, timeout=timeout, userAgent=userAgent)
+
+        # Return nothing of the content isn't one of the target mime-types.
+        if not _is_mime_type(url, response, only_mime_types):
+            return
+        try:
+            #return response.read()
+            if not decode:
+                return RawPage(response.content, response.headers, time.time())
+            return response.text
+        except httplib.IncompleteRead as e:
+            # This should rarely happen, and is often the fault of the server
+            # sending a malformed response.
+            #TODO:just abandon all content and return '' instead?
+            if not decode:
+                return RawPage(e.partial, response.headers, time.time())
+            return e.partial
+
+    def revalidate(self, url, headers, timeout=5, userAgent=None, only_mime_types=None, stream=False):
+        """
+        Sends a conditional request for a cached copy of the URL, given the
+        If-None-Match and/or If-Modified-Since headers.
+
+        Returns a tuple of (modified, page). If the page hasn't been modified,
+        page is None. Otherwise, it's the new content as with
+        fetch(decode=False), or the open response if streaming.
+        """
+        response = self.get(url, timeout=timeout, userAgent=userAgent, headers=headers, stream=stream)
+        if response.status_code == 304:
+            response.close()
+            return False, None
+        if not _is_mime_type(url, response, only_mime_types):
+            response.close()
+            return True, None
+        if stream:
+            return True, response
+        return True, RawPage(response.content, response.headers, time.time())
+
+    def open(self, url, timeout=5, userAgent=None, only_mime_types=None):
+        """
+        Sends a request for the URL and returns the response without reading
+        its content, so it can be streamed with response.iter_content(), or
+        None if it isn't one of the target mime-types.
+        """
+        response = self.get(url, timeout=timeout, userAgent=userAgent, stream=True)
+        if not _is_mime_type(url, response, only_mime_types):
+            response.close()
+            return
+        return response
+
+    def close(self):
+        self.session.close()
+
+def _is_mime_type(url, response, only_mime_types):
+    """
+    Returns true if the response is one of the target mime-types, or no
+    mime-types are targeted.
+    """
+    if not only_mime_types:
+        return True
+    import mimetypes
+    assert isinstance(only_mime_types, (tuple, list))
+    # Check for mimetype by looking at pattern in the URL.
+    # Not super accurate, but very fast.
+    ct, mt_encoding = mimetypes.guess_type(url)
+    # Then check for mimetype by actually requesting the resource and
+    # looking at the response.
+    # More accurate, but slower since we actually have to send a request.
+    if not ct:
+        ct = (response.headers.get('Content-Type') or '').split(';')[0]
+    #TODO:if still undefined, use magic.Magic(mime=True).from_file(url)?
+    return ct in only_mime_types
+
+_useragents = None
+_useragents_lock = threading.Lock()
+
+def get_random_useragent():
+    """
+    Returns a random browser user-agent string.
+
+    The fake_useragent database is loaded on first use rather than on
+    import, since loading it may require reading or downloading it.
+    """
+    global _useragents # pylint: disable=global-statement
+    with _useragents_lock:
+        if _useragents is None:
+            from fake_useragent import UserAgent
+            _useragents = UserAgent()
+    return _useragents.random
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+def get_default_fetcher():
+    """
+    Returns the Fetcher shared by all requests that aren't given one.
+    """
+    global _default_fetcher # pylint: disable=global-statement
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            _default_fetcher = Fetcher()
+        return _default_fetcher
+
+def fetch(url, timeout=5, userAgent=None, only_mime_types=None, fetcher=None, decode=True):
+    """
+    Retrieves the raw content of the URL.
+    """
+    fetcher = fetcher or get_default_fetcher()
+    return fetcher.fetch(url, timeout=timeout, userAgent=userAgent, only_mime_types=only_mime_types, decode=decode)
+
+class RobotsCache(object):
+    """
+    An in-memory, size-bounded LRU cache of parsed robots.txt policies,
+    keyed by the robots.txt URL of each host.
+
+    Policies expire after ttl seconds. Concurrent lookups for a host that
+    isn't cached wait on a single load instead of each downloading the
+    robots.txt.
+    """
+
+    def __init__(self, max_size=1000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._policies = OrderedDict() # {robots.txt url: (expiration, parser)}
+        self._loading = {} # {robots.txt url: threading.Event}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._policies)
+
+    def get(self, robotstxt_url, load):
+        """
+        Returns the cached parser for the robots.txt URL, calling load() to
+        create it if it isn't cached or has expired.
+        """
+        while True:
+            with self._lock:
+                entry = self._policies.pop(robotstxt_url, None)
+                if entry is not None and entry[0] > time.time():
+                    # Re-insert to mark it as the most recently used.
+                    self._policies[robotstxt_url] = entry
+                    self.hits += 1
+                    return entry[1]
+                event = self._loading.get(robotstxt_url)
+                if event is None:
+                    event = self._loading[robotstxt_url] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another thread is already loading this policy, so wait for it
+            # and then check the cache again.
+            event.wait()
+
+        try:
+            parser = load()
+            with self._lock:
+                self._policies[robotstxt_url] = (time.time() + self.ttl, parser)
+                while len(self._policies) > self.max_size:
+                    self._policies.popitem(last=False)
+            return parser
+        finally:
+            with self._lock:
+                del self._loading[robotstxt_url]
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._policies.clear()
+
+default_robots_cache = RobotsCache()
+
+_default_useragent = None
+
+def get_default_useragent():
+    """
+    Returns the user-agent urllib sends by default, which robots.txt rules
+    are checked against when no user-agent is given.
+    """
+    global _default_useragent # pylint: disable=global-statement
+    if _default_useragent is None:
+        from six.moves.urllib.request import OpenerDirector
+        for k, v in OpenerDirector().addheaders:
+            if k == "User-agent":
+                _default_useragent = v
+                break
+    return _default_useragent
+
+def load_robotstxt(robotstxt_url, useCache, cache_dir, userAgent=None, fetcher=None):
+    """
+    Returns a parser for the robots.txt at the given URL, read from the cache
+    if it was saved there in the last week, or downloaded otherwise.
+    """
+    from six.moves.urllib.error import HTTPError
+    from six.moves.urllib import robotparser
 
     key = generate_key(robotstxt_url)
+    cache = get_cache(useCache, cache_dir)
 
     robots_parser = robotparser.RobotFileParser()
-    cached_content = cache_get(cache_dir, key) if useCache else ''
+    cached_content = cache.get(key) if cache is not None else ''
     threshold = (time.time() - 86400 * 7)
 
-    if not cached_content or cache_info(cache_dir, key) < threshold:
+    if not cached_content or cache.get_mtime(key) < threshold:
         try:
-            cached_content = fetch(robotstxt_url, userAgent=userAgent)
-            if useCache:
-                cache_set(cache_dir, key, cached_content)
+            cached_content = fetch(robotstxt_url, userAgent=userAgent, fetcher=fetcher)
+            if cache is not None:
+                cache.set(key, cached_content)
         except HTTPError as he:
             # this block mimics the behaviour in the robotparser.read() method
             if he.code in (401, 403):
@@ -466,13 +2894,31 @@ def check_robotstxt(url, useCache, cache_dir, userAgent=None):
     except TypeError:
         pass
     robots_parser.parse((x for x in cached_content.split('\n')))
-    default_useragent = None
-    for k, v in OpenerDirector().addheaders:
-        if k == "User-agent":
-            default_useragent = v
-            break
+    return robots_parser
 
-    return robots_parser.can_fetch(userAgent or default_useragent, url)
+def check_robotstxt(url, useCache, cache_dir, userAgent=None, fetcher=None, robots_cache=None):
+    """
+    Returns true if the robots.txt of the URL's host allows fetching it.
+
+    Parsed policies are kept in the given RobotsCache, or a shared default
+    one, in front of the week-long cache on disk.
+    """
+    scheme, netloc, url_path, query, fragment = urlparse.urlsplit(url)
+    robotstxt_url = urlparse.urlunsplit((
+        scheme,
+        netloc,
+        '/robots.txt',
+        '',
+        '',
+    ))
+
+    if robots_cache is None:
+        robots_cache = default_robots_cache
+    robots_parser = robots_cache.get(
+        robotstxt_url,
+        lambda: load_robotstxt(robotstxt_url, useCache, cache_dir, userAgent=userAgent, fetcher=fetcher))
+
+    return robots_parser.can_fetch(userAgent or get_default_useragent(), url)
 
 def extractFromURL(url,
     cache=False,
@@ -485,16 +2931,28 @@ def extractFromURL(url,
     blur=5,
     ignore_robotstxt=False,
     only_mime_types=None,
-    raw=False):
+    raw=False,
+    fetcher=None,
+    stream=False,
+    max_bytes=None,
+    parser=None,
+    tidy=TIDY_ALWAYS,
+    freshness=None,
+    stats=None,
+    limits=None,
+    templates=None):
     """
-    Extracts text from a URL.
+    Extracts text from a URL, returned as UTF-8 bytes, or the decoded page
+    if raw.
 
     Parameters:
     url := string
         Remote URL or local filename where HTML will be read.
-    cache := bool
+    cache := bool or cache backend
         True=store and retrieve url from cache
         False=always retrieve url from the web
+        A FileCache, or compatible object, may be given to control the
+        cache's size and age limits or to use a different store.
     cacheDir := str
         Directory where cached url contents will be stored.
     verbose := bool
@@ -511,92 +2969,824 @@ def extractFromURL(url,
         A list of mime-types to limit parsing to.
         If the mime-type of the raw-content retrieved does not match
         one of these, a value of None will be returned.
+    fetcher := Fetcher
+        The fetcher whose connection pool requests are sent through.
+        If none given, a shared default fetcher is used.
+    stream := bool
+        True=feed the page to the extractor in chunks as it downloads,
+            so the whole page is never held in memory. Filters and tidy
+            can't be applied to a partial page, so filters are skipped,
+            the built-in normalizer is used in place of tidy, and the
+            encoding is taken from the response headers.
+        False=download the whole page before extracting it
+    max_bytes := int
+        When streaming, the most bytes of the page to download.
+    parser := str
+        The parser backend to use, one of PARSER_BACKENDS or 'auto'.
+        Since tidy makes the page well-formed, the backends give the same
+        text unless streaming.
+    tidy := str
+        always=clean up the page with tidy before parsing
+        auto=only use tidy if the page looks too malformed for the
+            built-in normalizer, see is_malformed_html()
+        never=always use the built-in normalizer, see TagBalancer
+        When streaming, tidy can't be used, so the normalizer always is.
+    freshness := FreshnessPolicy or int
+        When caching, decides how long a cached page is used before it's
+        revalidated with the server, or the seconds to use it for.
+        Pages with an ETag or Last-Modified header are revalidated with a
+        conditional request, reusing the cached text if they haven't
+        changed. If none given, cached pages are used indefinitely.
+    stats := ExtractStats or BatchStats
+        Records the time spent in each stage, the bytes read, the paths
+        scored, cache hits, and the encoding the page was decoded with and
+        its source. See ExtractStats.
+    limits := ExtractLimits
+        Budgets bounding the work done on the page. If one is hit, the text
+        found so far is returned, and isn't cached. The budget hit is
+        recorded as the truncated value of the stats.
+    templates := TemplateStore
+        Learns the path the text is found under on each domain, and scores
+        only that path on later pages from the domain while it keeps
+        winning. Text found this way isn't cached.
     """
+    if tidy not in TIDY_CHOICES:
+        raise ValueError('Invalid tidy mode %r. Must be one of: %s' % (tidy, ', '.join(TIDY_CHOICES)))
+    cached_content, html = _fetch_stage(
+        url,
+        cache=cache,
+        cacheDir=cacheDir,
+        verbose=verbose,
+        userAgent=userAgent,
+        timeout=timeout,
+        ignore_robotstxt=ignore_robotstxt,
+        only_mime_types=only_mime_types,
+        fetcher=fetcher,
+        stream=stream,
+        encoding=encoding,
+        filters=filters,
+        blur=blur,
+        raw=raw,
+        parser=parser,
+        tidy=tidy,
+        freshness=freshness,
+        stats=stats)
+    if cached_content is not None:
+        return cached_content
+    if not _has_content(html):
+        return ''
+    return _extract_stage(
+        url,
+        html,
+        cache=cache,
+        cacheDir=cacheDir,
+        verbose=verbose,
+        encoding=encoding,
+        filters=filters,
+        blur=blur,
+        raw=raw,
+        stream=stream,
+        max_bytes=max_bytes,
+        parser=parser,
+        tidy=tidy,
+        stats=stats,
+        limits=limits,
+        templates=templates)
+
+def _fetch_stage(url,
+    cache=False,
+    cacheDir='_cache',
+    verbose=False,
+    userAgent=None,
+    timeout=5,
+    ignore_robotstxt=False,
+    only_mime_types=None,
+    fetcher=None,
+    stream=False,
+    freshness=None,
+    stats=None,
+    **kwargs):
+    """
+    The network-bound half of extractFromURL().
 
-    blur = int(blur)
-
-    try:
-        import chardet
-    except ImportError as e:
-        raise ImportError(("%s\nYou need to install chardet.\n" + \
-             "e.g. sudo pip install chardet") % e)
+    Returns a tuple of (cached text, raw html), one of which will be empty.
+    When streaming, the open response is returned in place of the raw html.
+    """
 
     if only_mime_types and isinstance(only_mime_types, six.text_type):
         only_mime_types = only_mime_types.split(',')
-
-    # Load url from cache if enabled.
-    if cache:
-        if not os.path.isdir(cacheDir):
-            cache_perms = 488 # 750 in octal, '-rwxr-x---'
-            os.makedirs(cacheDir, cache_perms)
-
-        cache_key = generate_key(url)
-        cached_content = cache_get(cacheDir, cache_key)
-        if cached_content:
-            return cached_content
+    if stats is None:
+        stats = NULL_STATS
+
+    # Load url from cache if enabled and still fresh, preferring text already
+    # extracted with the same parameters, and otherwise the raw page.
+    cache = get_cache(cache, cacheDir)
+    info = None
+    if cache is not None:
+        info = _get_page_info(cache, url)
+        if info is not None and get_freshness_policy(freshness).is_fresh(info):
+            cached = _get_cached_page(cache, url, info, verbose, stream, kwargs, stats)
+            if cached is not None:
+                return cached
 
     if not ignore_robotstxt:
-        if not check_robotstxt(url, cache, cacheDir, userAgent=userAgent):
+        with stats.timer('robots'):
+            allowed = check_robotstxt(url, cache, cacheDir, userAgent=userAgent, fetcher=fetcher)
+        if not allowed:
             if verbose: print("Request denied by robots.txt")
-            return ''
+            return None, ''
+
+    fetcher = fetcher or get_default_fetcher()
+
+    # Revalidate a stale cached page, and use it if it hasn't changed.
+    conditional_headers = info and get_conditional_headers(info)
+    if conditional_headers:
+        if verbose: print('Revalidating %s...' % url)
+        with stats.timer('fetch'):
+            modified, page = fetcher.revalidate(
+                url,
+                conditional_headers,
+                timeout=timeout,
+                userAgent=userAgent,
+                only_mime_types=only_mime_types,
+                stream=stream)
+        if modified:
+            return None, page
+        if verbose: print('Not modified.')
+        stats.incr('not_modified')
+        _touch_page_info(cache, url, info)
+        cached = _get_cached_page(cache, url, info, verbose, stream, kwargs, stats)
+        if cached is not None:
+            return cached
 
     # Otherwise download the url.
     if verbose: print('Reading %s...' % url)
-    html = fetch(
-        url,
-        timeout=timeout,
-        userAgent=userAgent,
-        only_mime_types=only_mime_types)
-    if not html:
-        return ''
+    with stats.timer('fetch'):
+        if stream:
+            return None, fetcher.open(
+                url,
+                timeout=timeout,
+                userAgent=userAgent,
+                only_mime_types=only_mime_types)
+        html = fetch(
+            url,
+            timeout=timeout,
+            userAgent=userAgent,
+            only_mime_types=only_mime_types,
+            fetcher=fetcher,
+            decode=False)
+    return None, html
+
+def _get_cached_page(cache, url, info, verbose, stream, params, stats):
+    # Returns a (cached text, raw html) tuple for a cached page, or None.
+    encoding = params.get('encoding') or info['encoding']
+    if encoding and not params.get('raw'):
+        cached_content = cache.get(_get_text_key(info['hash'], encoding, params, stream=stream))
+        if cached_content is not None:
+            stats.incr('cache_text_hits')
+            stats.set('encoding', encoding)
+            return cached_content, None
+    if info['raw'] and not stream:
+        content = cache.get(generate_key(url, "%s.raw"))
+        if content is not None:
+            if verbose: print('Using cached copy of %s.' % url)
+            stats.incr('cache_raw_hits')
+            return None, RawPage(content, info['headers'], info.get('fetched'))
+    return None
+
+def _touch_page_info(cache, url, info):
+    # Marks a cached page as fresh again after revalidating it.
+    info['fetched'] = time.time()
+    cache.set(generate_key(url, "%s.page"), json.dumps(info, sort_keys=True))
+
+def _extract_stage(url, html,
+    cache=False,
+    cacheDir='_cache',
+    verbose=False,
+    encoding=None,
+    filters=None,
+    blur=5,
+    raw=False,
+    stream=False,
+    max_bytes=None,
+    parser=None,
+    tidy=TIDY_ALWAYS,
+    stats=None,
+    limits=None,
+    templates=None,
+    **kwargs):
+    """
+    The CPU-bound half of extractFromURL(), run on the html downloaded by
+    _fetch_stage().
+    """
+
+    blur = int(blur)
+    if stats is None:
+        stats = NULL_STATS
+
+    if stream:
+        return _stream_extract_stage(
+            url,
+            html,
+            cache=cache,
+            cacheDir=cacheDir,
+            verbose=verbose,
+            encoding=encoding,
+            filters=filters,
+            blur=blur,
+            raw=raw,
+            max_bytes=max_bytes,
+            parser=parser,
+            stats=stats,
+            limits=limits)
+
+    headers = fetched = None
+    if isinstance(html, RawPage):
+        html, headers, fetched = html
+    stats.incr('bytes', len(html))
 
     # If no encoding guess given, then attempt to determine
     # encoding automatically.
+    resolved_encoding = None
     if not encoding:
-        if isinstance(html, unicode):
-            html = html.encode('utf8', 'replace')
-        encoding_opinion = chardet.detect(html)
-        encoding = encoding_opinion['encoding']
-        if verbose: print('Using encoding %s.' % encoding)
-
-    # Save raw contents to cache if enabled.
+        with stats.timer('decode'):
+            if isinstance(html, unicode):
+                html = html.encode('utf8', 'replace')
+            encoding, source = resolve_encoding(html, headers)
+        resolved_encoding = encoding
+        stats.set('encoding_source', source)
+        if verbose: print('Using encoding %s from %s.' % (encoding, source))
+    stats.set('encoding', encoding)
+
+    # Save raw contents to cache if enabled, and reuse any text extracted
+    # from the same content with the same parameters, even from another url.
     if verbose: print('Read %i characters.' % len(html))
-    if cache:
-        raw_key = generate_key(url, "%s.raw")
-        cache_set(cacheDir, raw_key, html)
+    cache = get_cache(cache, cacheDir)
+    content_hash = text_key = None
+    if cache is not None:
+        content_hash = get_content_hash(html)
+        info = _get_page_info(cache, url)
+        if info is None or info['hash'] != content_hash or not info['raw']:
+            raw_key = generate_key(url, "%s.raw")
+            cache.set(raw_key, html)
+        if info is None or info['hash'] != content_hash or not info['raw'] or info.get('fetched') != fetched:
+            _set_page_info(
+                cache, url, content_hash, resolved_encoding, headers, raw=True, fetched=fetched or time.time())
+        if not raw:
+            params = dict(blur=blur, filters=filters, tidy=tidy, parser=parser)
+            text_key = _get_text_key(content_hash, encoding, params)
+            cached_content = cache.get(text_key)
+            if cached_content is not None:
+                stats.incr('cache_text_hits')
+                return cached_content
 
     # Apply filters.
     if filters:
         filter_names = map(str.strip, filters.split(','))
-        for filter_name in filter_names:
-            fltr = get_filter(filter_name)
-            html = fltr(html)
-
-    # Clean up HTML.
-    html = tidyHTML(html)
-    if verbose: print('Extracted %i characters.' % len(html))
+        size = len(html)
+        with stats.timer('filter'):
+            for filter_name in filter_names:
+                fltr = get_filter(filter_name)
+                html = fltr(html)
+        stats.incr('filtered_bytes', size - len(html))
+
+    # Clean up HTML, with tidy if needed, or otherwise while parsing.
+    use_tidy = tidy == TIDY_ALWAYS or (tidy == TIDY_AUTO and is_malformed_html(html))
+    if use_tidy:
+        # Tidy's output only depends on the content and filters, so it's
+        # reused across urls and extraction parameters.
+        tidy_key = None
+        if content_hash and isinstance(html, bytes):
+            tidy_key = _get_tidy_key(content_hash, filters)
+        tidied = cache.get(tidy_key) if tidy_key else None
+        if tidied is None:
+            with stats.timer('tidy'):
+                tidied = tidyHTML(html)
+            if tidy_key:
+                cache.set(tidy_key, tidied)
+        else:
+            stats.incr('cache_tidy_hits')
+        html = tidied
+        if verbose: print('Extracted %i characters.' % len(html))
 
     # Convert to Unicode.
     if not html:
         return ''
-    html = unicode(html, encoding=encoding, errors='replace')
+    if not isinstance(html, unicode):
+        with stats.timer('decode'):
+            html = unicode(html, encoding=encoding, errors='replace')
     if raw:
         return html
 
     # Extract text from HTML.
-    res = extractFromHTML(html, blur=blur)
+    extractor = TextExtractor()
+    if templates is not None:
+        res = templates.extract(
+            url, html, blur=blur, extractor=extractor, parser=parser, normalize=not use_tidy, stats=stats, limits=limits)
+    else:
+        res = extractFromHTML(
+            html, blur=blur, extractor=extractor, parser=parser, normalize=not use_tidy, stats=stats, limits=limits)
     assert isinstance(res, unicode)
+    if verbose and extractor.truncated: print('Stopped early, exceeded the %s limit.' % extractor.truncated)
+
+    # Save extracted text to cache if enabled, unless it's incomplete or
+    # only the domain's template was scored.
+    # The text is always returned as UTF-8, whatever the page's encoding, and
+    # without the byte order mark some codecs would add.
+    res = res.encode('utf-8', 'ignore')
+    if text_key is not None and not extractor.truncated and extractor._templateId is None:
+        cache.set(text_key, res)
+
+    return res
+
+def _has_content(html):
+    # Streamed responses are truthy only for successful statuses, so test
+    # for their presence instead.
+    if html is None:
+        return False
+    if hasattr(html, 'iter_content'):
+        return True
+    if isinstance(html, RawPage):
+        return bool(html.content)
+    return bool(html)
+
+def _stream_extract_stage(url, response,
+    cache=False,
+    cacheDir='_cache',
+    verbose=False,
+    encoding=None,
+    filters=None,
+    blur=5,
+    raw=False,
+    max_bytes=None,
+    chunk_size=65536,
+    parser=None,
+    stats=None,
+    limits=None):
+    """
+    Extracts text from a response as its content is downloaded.
+    """
+    if stats is None:
+        stats = NULL_STATS
+    if filters or raw:
+        response.close()
+        raise ValueError('Filters and raw output require the whole page, so cannot be used when streaming.')
+
+    chunks = response.iter_content(chunk_size)
+    resolved_encoding = None
+    if not encoding:
+        # Resolve the encoding from the first chunk, then put it back.
+        first_chunk = next(chunks, b'')
+        with stats.timer('decode'):
+            encoding, source = resolve_encoding(first_chunk, response.headers)
+        resolved_encoding = encoding
+        stats.set('encoding_source', source)
+        chunks = itertools.chain([first_chunk], chunks)
+        if verbose: print('Using encoding %s from %s.' % (encoding, source))
+    stats.set('encoding', encoding)
+
+    # Hash the page as it's read, so the text can be cached by content.
+    # Pages cut short by a limit aren't cached.
+    cache = get_cache(cache, cacheDir)
+    content_hash = None
+    if cache is not None and max_bytes is None:
+        content_hash = hashlib.sha1()
+        chunks = _iter_hashed(chunks, content_hash)
+    extractor = TextExtractor()
+    try:
+        res = extractFromChunks(
+            chunks,
+            encoding=encoding,
+            errors='replace',
+            blur=blur,
+            max_bytes=max_bytes,
+            extractor=extractor,
+            parser=parser,
+            normalize=True,
+            stats=stats,
+            limits=limits)
+    finally:
+        # Stop downloading if the byte limit was reached first.
+        response.close()
+    if verbose: print('Extracted %i characters.' % len(res))
 
     # Save extracted text to cache if enabled.
-    res = res.encode(encoding, 'ignore')
-    if cache:
-        cache_set(cacheDir, cache_key, res)
+    res = res.encode('utf-8', 'ignore')
+    if content_hash is not None and not extractor.truncated:
+        content_hash = content_hash.hexdigest()
+        info = _get_page_info(cache, url)
+        raw_cached = bool(info and info['hash'] == content_hash and info['raw'])
+        _set_page_info(
+            cache, url, content_hash, resolved_encoding, response.headers, raw=raw_cached, fetched=time.time())
+        params = dict(blur=blur, parser=parser)
+        cache.set(_get_text_key(content_hash, encoding, params, stream=True), res)
 
     return res
 
+def _iter_hashed(chunks, hasher):
+    for chunk in chunks:
+        hasher.update(chunk)
+        yield chunk
+
+class _URLBatch(object):
+    """
+    Schedules the downloads and extractions for extract_from_urls().
+
+    All methods run on the event loop. Downloads and extractions are
+    handed off to executors, and their completion callbacks dispatch
+    the next eligible downloads.
+    """
+
+    def __init__(self, loop, urls, concurrency, per_host, io_executor, executor, kwargs):
+        self.loop = loop
+        self.urls = urls
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.io_executor = io_executor
+        self.executor = executor
+        self.kwargs = kwargs
+        self.results = [None]*len(urls)
+        self.remaining = len(urls)
+        self.active = 0
+        self.host_active = defaultdict(int) # {host: downloads in flight}
+        self.queues = OrderedDict() # {host: deque([url index])}
+        for index, url in enumerate(urls):
+            host = urlparse.urlsplit(url).netloc
+            self.queues.setdefault(host, deque()).append(index)
+        self.finished = loop.create_future()
+        if not urls:
+            self.finished.set_result([])
+
+    def dispatch(self):
+        """
+        Starts as many queued downloads as the concurrency limits allow.
+        """
+        for host in list(self.queues):
+            queue = self.queues[host]
+            while queue and self.active < self.concurrency and self.host_active[host] < self.per_host:
+                self.download(host, queue.popleft())
+            if not queue:
+                del self.queues[host]
+            if self.active >= self.concurrency:
+                break
+
+    def download(self, host, index):
+        self.active += 1
+        self.host_active[host] += 1
+        future = self.loop.run_in_executor(
+            self.io_executor,
+            functools.partial(_fetch_stage, self.urls[index], **self.kwargs))
+        future.add_done_callback(functools.partial(self.on_downloaded, host, index))
+
+    def on_downloaded(self, host, index, future):
+        self.active -= 1
+        self.host_active[host] -= 1
+        if future.exception() is not None:
+            self.finish(index, future=future)
+        else:
+            cached_content, html = future.result()
+            if cached_content is not None:
+                self.finish(index, text=cached_content)
+            elif not _has_content(html):
+                self.finish(index, text='')
+            else:
+                future = self.loop.run_in_executor(
+                    self.executor,
+                    functools.partial(_extract_stage, self.urls[index], html, **self.kwargs))
+                future.add_done_callback(functools.partial(self.finish, index))
+        self.dispatch()
+
+    def finish(self, index, future=None, text=None):
+        if future is not None:
+            error = future.exception()
+            if error is not None:
+                self.results[index] = ExtractResult(index, None, '%s: %s' % (type(error).__name__, error))
+            else:
+                self.results[index] = ExtractResult(index, future.result(), None)
+        else:
+            self.results[index] = ExtractResult(index, text, None)
+        self.remaining -= 1
+        if not self.remaining:
+            self.finished.set_result(self.results)
+
+def extract_from_urls(urls, concurrency=10, per_host=2, executor=None, loop=None, **kwargs):
+    """
+    Extracts text from many URLs concurrently, for use with asyncio, e.g.
+
+        results = await extract_from_urls(urls, concurrency=20, per_host=2)
+
+    This isn't a coroutine, and the I/O isn't non-blocking. Downloads are
+    blocking requests run in a pool of `concurrency` threads, with no more
+    than `per_host` in flight to any single host, so network latency
+    overlaps across hosts while each host is fetched politely. Tidying and
+    extraction run in the given executor, or the loop's default executor
+    if none is given. Only the result is awaitable, so the event loop
+    never blocks.
+
+    If no loop is given, it must be called from a coroutine running on
+    the loop to use.
+
+    Remaining keyword arguments are passed through as in extractFromURL().
+
+    Returns a future resolving to a list with an
+    ExtractResult(index, text, error) per URL, in the same order as the
+    URLs. A failure on one URL is reported in its result instead of
+    aborting the batch.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    if loop is None:
+        # Raises a RuntimeError if no loop is running. Python < 3.7 only
+        # has get_event_loop().
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+    io_executor = ThreadPoolExecutor(max(1, concurrency))
+    batch = _URLBatch(
+        loop, list(urls), max(1, concurrency), max(1, per_host), io_executor, executor, kwargs)
+    batch.finished.add_done_callback(lambda future: io_executor.shutdown(wait=False))
+    batch.dispatch()
+    return batch.finished
+
+def _batch_worker(args):
+    source, kwargs = args
+    stats = ExtractStats()
+    t0 = time.time()
+    text, error = u'', None
+    try:
+        if os.path.isfile(source):
+            # Local files are extracted the same way as downloaded pages.
+            with stats.timer('fetch'):
+                with open(source, 'rb') as fin:
+                    html = fin.read()
+            text = _extract_stage(source, html, stats=stats, **kwargs) or u''
+        else:
+            text = extractFromURL(source, stats=stats, **kwargs) or u''
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return OrderedDict([
+        ('input', source),
+        ('status', 'error' if error else ('ok' if text else 'empty')),
+        ('text', text),
+        ('error', error),
+        ('seconds', time.time() - t0),
+        ('timings', stats.timings),
+        ('cache_hit', bool(stats.counters.get('cache_text_hits') or stats.counters.get('cache_raw_hits'))),
+    ])
+
+def extract_batch(sources, workers=1, skip=None, **kwargs):
+    """
+    Extracts text from many URLs or local filenames using a pool of worker
+    processes, so the cost of starting Python and importing is only paid
+    once per worker. Local files are extracted like downloaded pages, but
+    without the robots.txt check.
+
+    Parameters:
+    sources := iterable of strings
+        The URLs or filenames. It's consumed lazily.
+    workers := int
+        The number of worker processes. If 1 or less, sources are
+        extracted in the current process.
+    skip := set of strings
+        Sources to leave out, such as those already completed by an
+        interrupted run. See read_completed_sources().
+
+    Remaining keyword arguments are passed through as in extractFromURL().
+
+    Yields a dictionary per source as soon as it's done, with the input,
+    the status, one of ok, empty or error, the text, the error, the total
+    seconds, the seconds per stage and whether the cache was hit.
+    """
+    import multiprocessing
+
+    skip = skip or ()
+    tasks = ((source, kwargs) for source in sources if source not in skip)
+
+    if workers <= 1:
+        for task in tasks:
+            yield _batch_worker(task)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(_batch_worker, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def iter_batch_sources(f):
+    """
+    Yields the URLs or filenames listed in a file-like object, one per line,
+    skipping blank lines and lines starting with '#'.
+    """
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def read_completed_sources(filename):
+    """
+    Returns the set of inputs recorded in a JSON lines file written by
+    extract_batch(), so an interrupted run can be resumed. A line cut short
+    by the interruption is ignored, so its input is extracted again, and so
+    are inputs whose extraction failed with an error.
+    """
+    completed = set()
+    if not os.path.exists(filename):
+        return completed
+    with codecs.open(filename, 'r', 'utf-8', errors='replace') as fin:
+        for line in fin:
+            try:
+                result = json.loads(line)
+                if not result.get('error'):
+                    completed.add(result['input'])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                pass
+    return completed
+
+def _open_batch_output(filename, resume):
+    # Opens the JSON lines output, starting on a new line if a previous run
+    # was interrupted mid-line.
+    if filename is None or filename == '-':
+        return None
+    if resume and os.path.exists(filename) and os.path.getsize(filename):
+        with open(filename, 'rb') as fin:
+            fin.seek(-1, os.SEEK_END)
+            complete = fin.read(1) == b'\n'
+        fout = open(filename, 'ab')
+        if not complete:
+            fout.write(b'\n')
+        return fout
+    return open(filename, 'wb')
+
 def filter_remove_entities(text):
+    if isinstance(text, bytes):
+        return re.sub(b"&#[a-zA-Z]+", b'', text)
     return re.sub("&#[a-zA-Z]+", '', text)
 
+# Tokenizes a page as a parser would, just enough to find the comments, the
+# bodies of script and style elements, and the other elements in
+# IGNORED_TAGS, whose text is always ignored. Each match skips over text,
+# other tags and declarations to the next of these, or to an element whose
+# contents are raw text to some parsers. Anything the parsers might disagree
+# on, like a comment containing '-- ', a script body containing '</script'
+# or '<script', a self-closing script, a tag with unbalanced quotes or a
+# title containing tags, is matched as stop, and the rest of the page is
+# left alone.
+RAW_TEXT_TAGS = ('script', 'style', 'title', 'textarea', 'xmp', 'iframe', 'noembed', 'noframes', 'plaintext')
+
+SUBTREE_TAGS = tuple(tag for tag in IGNORED_TAGS if tag not in RAW_TEXT_TAGS)
+
+# The elements that can't be inside an emptied element, since parsers move
+# them, or their contents, elsewhere in the page.
+UNSAFE_SUBTREE_TAGS = frozenset(RAW_TEXT_TAGS + ('html', 'head', 'body', 'frameset', 'frame'))
+
+ATTRIBUTES = r'''(?:\s(?:[^<>"']|"[^"]*"|'[^']*')*)?(?<!/)'''
+
+COMMENT = r'<!--(?!-?>)[^-]*(?:-(?!-[-\s!>])[^-]*)*-->'
+
+def _raw_text_body(group):
+    return (
+        r'<(?P<' + group + r'>script|style)' + ATTRIBUTES + r'>'
+        r'[^<]*(?:<(?!/\s*(?:script|style)|script)[^<]*)*</(?P=' + group + r')\s*>')
+
+IGNORED_CONTENT_PATTERN = (
+    r'(?:[^<]+'
+    r'|<(?!(?:' + '|'.join(RAW_TEXT_TAGS) + r')\b|(?:' + '|'.join(SUBTREE_TAGS) + r''')(?=[\s/>]))'''
+    r'''[a-zA-Z][^<>"']*(?:(?:"[^"]*"|'[^']*')[^<>"']*)*>'''
+    r'|</(?!(?:' + '|'.join(RAW_TEXT_TAGS) + r''')\b)[a-zA-Z][^<>"']*(?:(?:"[^"]*"|'[^']*')[^<>"']*)*>'''
+    r'|<![a-zA-Z][^<>]*>'
+    r'|<\?[^<>]*>'
+    r'|<(?![a-zA-Z/!?]))*'
+    r'(?:(?P<comment>' + COMMENT + r')'
+    r'|(?P<start><(?P<tag>script|style)' + ATTRIBUTES + r'>)'
+    r'[^<]*(?:<(?!/\s*(?:script|style)|script)[^<]*)*(?P<end></(?P=tag)\s*>)'
+    r'|(?P<raw><(?P<raw_tag>title|textarea|xmp|iframe|noembed|noframes)' + ATTRIBUTES + r'>[^<]*</(?P=raw_tag)\s*>)'
+    r'|(?P<subtree><(?P<subtree_tag>' + '|'.join(SUBTREE_TAGS) + r')' + ATTRIBUTES + r'>)'
+    r'|<|$)'
+)
+
+# Tokenizes the contents of an element in IGNORED_TAGS, skipping over text,
+# comments, scripts and styles to the next tag, which is matched as stop if
+# it can't be read the same way by every parser.
+SUBTREE_PATTERN = (
+    r'(?:[^<]+|' + COMMENT + r'|' + _raw_text_body('body_tag') + r')*'
+    r'''(?:<(?P<start>[a-zA-Z][a-zA-Z0-9:_-]*)(?:\s(?:[^<>"'/]|/(?!>)|"[^"]*"|'[^']*')*)?(?P<slash>/?)>'''
+    r'|</(?P<end>[a-zA-Z][a-zA-Z0-9:_-]*)\s*>'
+    r'|<|$)'
+)
+
+IGNORED_CONTENT_PATTERNS = {
+    unicode: (
+        re.compile(IGNORED_CONTENT_PATTERN, re.I | re.S),
+        re.compile(SUBTREE_PATTERN, re.I | re.S)),
+    bytes: (
+        re.compile(IGNORED_CONTENT_PATTERN.encode('ascii'), re.I | re.S),
+        re.compile(SUBTREE_PATTERN.encode('ascii'), re.I | re.S)),
+}
+
+def _get_tag_name(name):
+    name = name.lower()
+    if six.PY3 and isinstance(name, bytes):
+        name = name.decode('ascii')
+    return name
+
+def _get_implied_closes(tag):
+    # The elements whose end the start tag implies, see TagBalancer.
+    closes = IMPLIED_END_TAGS.get(tag, ())
+    if tag in P_CLOSING_TAGS:
+        closes += ('p',)
+    return closes
+
+def _find_subtree_end(text, pos, tag, pattern):
+    """
+    Returns the start and end of the end tag closing the element whose
+    contents start at pos, or None if the parsers could disagree on where
+    it is, because the contents aren't balanced, or contain a start tag
+    that implies the end of the element, or of one outside it.
+    """
+    stack = [tag]
+    # These are already closed when the element starts, so a start tag
+    # implying their end can't close anything outside it.
+    closed = frozenset(_get_implied_closes(tag))
+    while True:
+        match = pattern.match(text, pos)
+        if match.group('start'):
+            name = _get_tag_name(match.group('start'))
+            if name in UNSAFE_SUBTREE_TAGS:
+                return None
+            if name not in VOID_TAGS:
+                if match.group('slash'):
+                    return None
+                closes = _get_implied_closes(name)
+                if closes:
+                    for open_tag in reversed(stack):
+                        if open_tag in closes:
+                            return None
+                        if open_tag in SCOPE_TAGS:
+                            break
+                    else:
+                        if not closed.issuperset(closes):
+                            return None
+                stack.append(name)
+        elif match.group('end'):
+            if _get_tag_name(match.group('end')) != stack.pop():
+                return None
+            if not stack:
+                return match.start('end') - 2, match.end()
+        else:
+            return None
+        pos = match.end()
+
+def filter_strip_ignored(text):
+    """
+    Empties the comments, scripts, styles and other elements in IGNORED_TAGS
+    of a page, whose text is ignored anyway, so the parser doesn't have to
+    read them.
+
+    The elements themselves are kept, and only emptied where their contents
+    are balanced, so the paths and text of the rest of the page are
+    unchanged. Void elements inside them are assumed to be closed, as they
+    are with normalize, tidy or the lxml backend, so the text is only the
+    same as without the filter when the page is parsed one of those ways.
+    With the bare html.parser, a void element left open inside an emptied
+    element shifts the paths after it, and the text can differ.
+    """
+    pattern, subtree_pattern = IGNORED_CONTENT_PATTERNS[bytes if isinstance(text, bytes) else unicode]
+    pieces = []
+    last = pos = 0
+    while True:
+        match = pattern.match(text, pos)
+        if match.group('comment'):
+            start = match.start('comment') + 4
+            end = pos = match.end()
+            end -= 3
+        elif match.group('start'):
+            start = match.end('start')
+            end = match.start('end')
+            pos = match.end()
+        elif match.group('raw'):
+            pos = match.end()
+            continue
+        elif match.group('subtree'):
+            start = pos = match.end()
+            span = _find_subtree_end(text, start, _get_tag_name(match.group('subtree_tag')), subtree_pattern)
+            if span is None:
+                continue
+            end, pos = span
+        else:
+            break
+        if end > start:
+            pieces.append(text[last:start])
+            last = end
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return text[:0].join(pieces)
+
 def get_filter_names():
     return [
         k.replace('filter_', '')
@@ -656,14 +3846,69 @@ if __name__ == '__main__':
             "A bigger number will find more text, but that text will morel likely be junk. "
             "A smaller number will find less text, but that text is less likely to be junk.")
 
+    parser.add_option(
+        "-t", "--tidy", dest="tidy",
+        default=TIDY_ALWAYS,
+        choices=TIDY_CHOICES,
+        help=("When to clean up the page with tidy, one of [%s]. "
+            "Otherwise a faster built-in normalizer is used.") % '|'.join(TIDY_CHOICES))
+
+    parser.add_option(
+        "-l", "--list", dest="list",
+        default=None,
+        help="Extracts each url or filename listed, one per line, in the given file, "
+            "or stdin if -, writing a JSON line per input.")
+    parser.add_option(
+        "-j", "--jobs", dest="jobs",
+        default=1, type='int',
+        help="The number of worker processes used to extract a list.")
+    parser.add_option(
+        "-o", "--output", dest="output",
+        default=None,
+        help="The file JSON lines are written to when extracting a list. "
+            "Defaults to stdout.")
+    parser.add_option(
+        "-r", "--resume", dest="resume",
+        action='store_true',
+        default=False,
+        help="Skips the inputs already in the output file, appending the rest. Requires --output.")
+
     (options, args) = parser.parse_args()
+    kwargs = options.__dict__.copy()
+    for name in ('list', 'jobs', 'output', 'resume'):
+        del kwargs[name]
+
+    if options.resume and not options.output:
+        parser.error('--resume requires --output')
+    if options.list is not None:
+        if options.list == '-':
+            sources = iter_batch_sources(sys.stdin)
+        else:
+            sources = iter_batch_sources(codecs.open(options.list, 'r', 'utf-8'))
+        skip = None
+        if options.resume:
+            skip = read_completed_sources(options.output)
+        fout = _open_batch_output(options.output, options.resume)
+        try:
+            for result in extract_batch(sources, workers=options.jobs, skip=skip, **kwargs):
+                line = json.dumps(result) + '\n'
+                if fout is None:
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+                else:
+                    fout.write(line.encode('utf-8'))
+                    fout.flush()
+        finally:
+            if fout is not None:
+                fout.close()
+        sys.exit()
 
     if len(args) < 1:
         parser.print_help()
         sys.exit()
 
     url = args[0]
-    s = extractFromURL(url=url, **options.__dict__)
+    s = extractFromURL(url=url, **kwargs)
     s = s.decode('utf-8')
     try:
         sys.stdout.write(s.encode('utf-8', errors='ignore'))